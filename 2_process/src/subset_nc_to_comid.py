@@ -3,25 +3,72 @@ import numpy as np
 import pandas as pd
 
 
-def ds_to_dataframe_faster(ds):
+def ds_to_dataframe_faster(ds, as_arrow=False):
     """
-    doing this to try to avoid the multi-index joins
+    doing this to try to avoid the multi-index joins. The long table is built
+    straight from the (COMID, time) arrays of each variable, one allocation per
+    column: values are raveled time-major, COMID is tiled and time is repeated.
+    If as_arrow is True a pyarrow Table is returned, which reticulate can hand
+    to the R arrow package without another copy
+    """
+    data_vars = [var for var in ds.data_vars if "lat" not in var and "lon" not in var]
+    dims = ds[data_vars[0]].dims
+    if set(dims) != {'COMID', 'time'}:
+        raise ValueError(f"expected dims COMID and time, got {dims} for {data_vars[0]}")
+    for var in data_vars:
+        if ds[var].dims != dims:
+            raise ValueError(f"dims of {var} {ds[var].dims} don't match {dims}")
+
+    comids = ds['COMID'].values
+    times = ds['time'].values
+    columns = {}
+    for var in data_vars:
+        # rows are ordered by time then COMID
+        columns[var] = ds[var].transpose('time', 'COMID').values.ravel()
+    columns['COMID'] = np.tile(comids, len(times))
+    columns['time'] = np.repeat(times, len(comids))
+
+    if as_arrow:
+        import pyarrow as pa
+        return pa.table(columns)
+    return pd.DataFrame(columns)
+
+
+def ds_to_parquet_chunked(ds, out_file, chunk_size):
+    """
+    write the long format table of ds_to_dataframe_faster to a parquet file one
+    chunk of time steps at a time, so memory is bounded by the chunk size
+    rather than by the length of the record
+    """
+    import pyarrow.parquet as pq
+
+    writer = None
+    try:
+        for start in range(0, ds.sizes['time'], chunk_size):
+            ds_chunk = ds.isel(time=slice(start, start + chunk_size)).load()
+            table = ds_to_dataframe_faster(ds_chunk, as_arrow=True)
+            if writer is None:
+                writer = pq.ParquetWriter(out_file, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    return out_file
+
+
+def subset_nc_to_comids(nc_file, comids, out_file=None, chunk_size=None):
+    """
+    subset the gridMET netcdf to the given COMIDs and return it as a long
+    format data frame. If out_file is given, the netcdf is opened with dask
+    chunks of chunk_size time steps along time and the subset is streamed to a
+    parquet file chunk by chunk instead (the path to the file is returned)
     """
-    series_list = []
-    for var in ds.data_vars:
-        if "lat" not in var and "lon" not in var:
-            df_var = ds[var].to_pandas().reset_index()
-            df_var_tidy = df_var.melt(id_vars='COMID', value_name=var)
-            series_list.append(df_var_tidy[var])
-    series_list.append(df_var_tidy['COMID'])
-    series_list.append(df_var_tidy['time'])
-    return pd.concat(series_list, axis=1)
-
-
-def subset_nc_to_comids(nc_file, comids):
     comids = [int(c) for c in comids]
 
-    ds = xr.open_dataset(nc_file)
+    if chunk_size:
+        ds = xr.open_dataset(nc_file, chunks={'time': chunk_size})
+    else:
+        ds = xr.open_dataset(nc_file)
 
     # filter out comids that are not in climate drivers (should only be 4781767)
     comids = np.array(comids)
@@ -33,4 +80,7 @@ def subset_nc_to_comids(nc_file, comids):
     if len(comids_not_in_climate) > 0 :
         assert list(comids_not_in_climate) == [4781767]
     ds_comids = ds.sel(COMID=comids_in_climate)
+    if out_file:
+        return ds_to_parquet_chunked(ds_comids, out_file,
+                                     chunk_size or ds_comids.sizes['time'])
     return ds_to_dataframe_faster(ds_comids)
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the information theory functions in it_functions.py
+
+The reference functions below are the np.histogramdd versions of calc2Dpdf,
+calc3Dpdfs and calcTE that the integer-coded kernel replaced. They are used to
+check that the results have not changed and to report the speedup.
+
+The hot path suite (benchmark_hot_paths) times calcEntropy, calc2Dpdf,
+calc3Dpdfs, lag_data, calcMI, calcTE, calcMI_crit, calcTE_crit, calc_it_lags,
+calc_it_metrics and pre_proc_func.remove_seasonal_signal on synthetic daily
+series with nan gaps, sweeping nobs, nbins and n_lags. The results of every
+case are checked against baselines (benchmark_baselines.npz) frozen from
+it_functions.py as it was before it was optimized (it_functions_reference.py,
+see ReferenceImplementation), so optimized versions can be checked for both
+the numbers and the speed. test_it_functions.py runs the same check with pytest.
+
+run from 2a_model/src with:
+    python benchmark_it_functions.py            # hot paths, checked against the baselines
+    python benchmark_it_functions.py --reference  # also compare against np.histogramdd
+    python benchmark_it_functions.py --freeze   # (re)write the baselines from the reference
+"""
+import argparse
+import math
+import os
+import timeit
+
+import numpy as np
+import pandas as pd
+from scipy.stats import pearsonr
+
+import it_functions
+import it_functions_reference
+
+
+def ref_calc2Dpdf(M, nbins):
+    counts, binEdges = np.histogramdd(M, bins=nbins)
+    p_xy = counts/np.sum(counts)
+    p_x = np.sum(p_xy, axis=1)
+    p_y = np.sum(p_xy, axis=0)
+    return p_x, p_y, p_xy
+
+
+def ref_calc3Dpdfs(M, nbins):
+    pdf, edges = np.histogramdd(M, bins=nbins)
+    return pdf/np.sum(pdf)
+
+
+def ref_calcTE(M, shift, nbins):
+    M_lagged = it_functions.lag_data(M, shift)
+    M_short = M_lagged[~np.isnan(M_lagged).any(axis=1)]
+    _, _, p_xlyl = ref_calc2Dpdf(M_short[:, (0, 2)], nbins)
+    T1 = it_functions.calcEntropy(p_xlyl)
+    py, pyl, p_yulyl = ref_calc2Dpdf(M_short[:, (1, 2)], nbins)
+    T2 = it_functions.calcEntropy(p_yulyl)
+    T3 = it_functions.calcEntropy(py)
+    T4 = it_functions.calcEntropy(ref_calc3Dpdfs(M_short, nbins))
+    return (T1+T2-T3-T4)/T3
+
+
+def ref_calcMI(M, nbins):
+    p_x, p_y, p_xy = ref_calc2Dpdf(M, nbins)
+    Hx = it_functions.calcEntropy(p_x)
+    Hy = it_functions.calcEntropy(p_y)
+    Hxy = it_functions.calcEntropy(p_xy)
+    return (Hx+Hy-Hxy)/Hy
+
+
+def make_series(nobs, frac_nan=0.05, seed=0):
+    """
+    synthetic standardized source/sink pair with a lagged dependence and nan gaps
+    """
+    rng = np.random.default_rng(seed)
+    x = np.sin(np.arange(nobs)*2*np.pi/365) + rng.normal(scale=0.5, size=nobs)
+    y = np.roll(x, 2) + rng.normal(scale=0.5, size=nobs)
+    for col in (x, y):
+        col[rng.choice(nobs, int(frac_nan*nobs), replace=False)] = np.nan
+    M = np.stack((x, y), axis=1)
+    return (M - np.nanmean(M, axis=0))/np.nanstd(M, axis=0, ddof=1)
+
+
+def time_it(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3))/number
+
+
+def benchmark_pdfs(nobs_list=(1000, 5000, 20000), nbins_list=(5, 11, 21),
+                   shift=1, number=20):
+    """
+    compare calcTE and calcMI against the np.histogramdd reference versions
+    """
+    rows = []
+    for nobs in nobs_list:
+        M = make_series(nobs)
+        M_short = M[~np.isnan(M).any(axis=1)]
+        for nbins in nbins_list:
+            TE = it_functions.calcTE(M, shift, nbins)
+            MI = it_functions.calcMI(M_short, nbins)
+            assert np.isclose(TE, ref_calcTE(M, shift, nbins), rtol=1e-10, atol=1e-12)
+            assert np.isclose(MI, ref_calcMI(M_short, nbins), rtol=1e-10, atol=1e-12)
+            for name, new, ref in [
+                    ('calcTE', lambda: it_functions.calcTE(M, shift, nbins),
+                     lambda: ref_calcTE(M, shift, nbins)),
+                    ('calcMI', lambda: it_functions.calcMI(M_short, nbins),
+                     lambda: ref_calcMI(M_short, nbins))]:
+                t_new = time_it(new, number)
+                t_ref = time_it(ref, number)
+                rows.append({'function': name, 'nobs': nobs, 'nbins': nbins,
+                             'histogramdd_ms': t_ref*1e3, 'bincount_ms': t_new*1e3,
+                             'speedup': t_ref/t_new})
+    return pd.DataFrame(rows)
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'benchmark_baselines.npz')
+
+
+class _ReferencePreProc:
+    def __init__(self, module):
+        self.ppf = module.pre_proc_func()
+
+    def remove_seasonal_signal(self, sr, window=None):
+        if window is not None:
+            # the smoothed doy means are newer than the reference, so the current
+            # version is its own baseline
+            return it_functions.pre_proc_func().remove_seasonal_signal(sr, window=window)
+        return np.asarray(self.ppf.remove_seasonal_signal(sr), dtype=float)
+
+
+class ReferenceImplementation:
+    """
+    the functions of an older it_functions module (it_functions_reference by
+    default) with the interface of the current one, for freezing the baselines.
+
+    The reference has no critical thresholds (at a0715d3 calcMI_crit and
+    calcTE_crit returned 0, so they aren't kept), so they are computed from
+    its calcMI and calcTE on the same shuffled surrogates the current version
+    draws: the same generator, chunks and permutations
+    (it_functions._shuffle_index), each surrogate built as a full array with
+    the nan values in place and binned separately. calc_it_lags is composed
+    lag by lag from the reference lag_data, calcMI, calcTE and pearsonr, as in
+    its calc_it_metrics, with the child seeds of the current version
+    (it_functions._spawn_seeds) for each direction and lag.
+    """
+    chunk_size = 100
+
+    def __init__(self, module=it_functions_reference):
+        self.module = module
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+    def pre_proc_func(self):
+        return _ReferencePreProc(self.module)
+
+    def _surrogates(self, M, numiter, seed):
+        rng = np.random.default_rng(seed)
+        valid_x = ~np.isnan(M[:, 0])
+        valid_y = ~np.isnan(M[:, 1])
+        x = M[valid_x, 0]
+        y = M[valid_y, 1]
+        for start in range(0, numiter, self.chunk_size):
+            n = min(self.chunk_size, numiter - start)
+            I_x = it_functions._shuffle_index(x.size, n, rng)
+            I_y = it_functions._shuffle_index(y.size, n, rng)
+            for k in range(n):
+                Mss = np.ones(np.shape(M))*np.nan
+                Mss[valid_x, 0] = x[I_x[k]]
+                Mss[valid_y, 1] = y[I_y[k]]
+                yield Mss
+
+    @staticmethod
+    def _crit(values, alpha, numiter):
+        return np.sort(values)[min(math.ceil((1-alpha)*numiter), numiter - 1)]
+
+    def calcMI_crit(self, M, nbins, alpha, numiter=500, seed=None):
+        MIss = [self.module.calcMI(Mss[~np.isnan(Mss).any(axis=1)], nbins)
+                for Mss in self._surrogates(M, numiter, seed)]
+        return self._crit(MIss, alpha, numiter)
+
+    def calcTE_crit(self, M, shift, nbins, alpha, numiter=500, seed=None):
+        TEss = [self.module.calcTE(Mss, shift, nbins)
+                for Mss in self._surrogates(M, numiter, seed)]
+        return self._crit(TEss, alpha, numiter)
+
+    def calc_it_lags(self, M, n_lags, nbins, alpha=None, calc_MI=True, numiter=500, seed=None):
+        it_lags = {'MI': [], 'MIcrit': [], 'TE': [], 'TEcrit': [], 'corr': []}
+        lag_seeds = it_functions._spawn_seeds(seed, n_lags)
+        for i in range(n_lags):
+            M_lagged = self.module.lag_data(M, shift=i)
+            M_short = M_lagged[~np.isnan(M_lagged).any(axis=1)]
+            it_lags['TE'].append(self.module.calcTE(M, i, nbins))
+            if alpha is not None:
+                it_lags['TEcrit'].append(self.calcTE_crit(M, i, nbins, alpha, numiter,
+                                                          lag_seeds[i]))
+            if calc_MI:
+                it_lags['MI'].append(self.module.calcMI(M_short[:, (0, 1)], nbins))
+                it_lags['corr'].append(pearsonr(M_short[:, 0], M_short[:, 1])[0])
+                if alpha is not None:
+                    it_lags['MIcrit'].append(self.calcMI_crit(M_short[:, (0, 1)], nbins, alpha,
+                                                              numiter, lag_seeds[i]))
+        return {key: np.array(val) for key, val in it_lags.items()}
+
+    def calc_it_metrics(self, M, Mswap, n_lags, nbins, alpha, calc_swap=True, numiter=500,
+                        seed=None):
+        seed, seed_swap = it_functions._spawn_seeds(seed, 2)
+        it_lags = self.calc_it_lags(M, n_lags, nbins, alpha=alpha, numiter=numiter, seed=seed)
+        it_metrics = {key: list(val) for key, val in it_lags.items()}
+        it_metrics['TEswap'] = []
+        it_metrics['TEcritswap'] = []
+        if calc_swap:
+            it_lags_swap = self.calc_it_lags(Mswap, n_lags, nbins, alpha=alpha, calc_MI=False,
+                                             numiter=numiter, seed=seed_swap)
+            it_metrics['TEswap'] = list(it_lags_swap['TE'])
+            it_metrics['TEcritswap'] = list(it_lags_swap['TEcrit'])
+        return it_metrics
+
+
+def make_daily_series(nobs, frac_nan=0.05, seed=0):
+    """
+    make_series as a DataFrame of daily values (for remove_seasonal_signal)
+    """
+    M = make_series(nobs, frac_nan=frac_nan, seed=seed)
+    index = pd.date_range('2007-10-01', periods=nobs, freq='D')
+    return pd.DataFrame(M, index=index, columns=['source', 'sink'])
+
+
+def hot_path_cases(impl=it_functions, nobs_list=(1000, 5000), nbins_list=(5, 11),
+                   n_lags_list=(10, 30), crit_n_lags=5, numiter=100, alpha=0.05, seed=0):
+    """
+    yields (function name, case parameters, function) for every benchmark case.
+    Each function returns its result as a numpy array (or tuple of arrays) so it
+    can be compared against the frozen baselines. impl is it_functions or a
+    ReferenceImplementation
+    """
+    ppf = impl.pre_proc_func()
+    for nobs in nobs_list:
+        M = make_series(nobs)
+        Mswap = M[:, (1, 0)]
+        M_lagged = impl.lag_data(M, 1)
+        M_short = M_lagged[~np.isnan(M_lagged).any(axis=1)]
+        df = make_daily_series(nobs)
+
+        yield 'lag_data', dict(nobs=nobs), lambda M=M: impl.lag_data(M, 1)
+        for window in (None, 15):
+            yield ('remove_seasonal_signal', dict(nobs=nobs, window=window),
+                   lambda df=df, window=window: ppf.remove_seasonal_signal(df['sink'], window=window))
+
+        for nbins in nbins_list:
+            pdf = impl.calc3Dpdfs(M_short, nbins)
+            yield ('calcEntropy', dict(nobs=nobs, nbins=nbins),
+                   lambda pdf=pdf: np.array(impl.calcEntropy(pdf)))
+            yield ('calc2Dpdf', dict(nobs=nobs, nbins=nbins),
+                   lambda M_short=M_short, nbins=nbins: impl.calc2Dpdf(M_short[:, (0, 1)], nbins))
+            yield ('calc3Dpdfs', dict(nobs=nobs, nbins=nbins),
+                   lambda M_short=M_short, nbins=nbins: impl.calc3Dpdfs(M_short, nbins))
+            yield ('calcMI', dict(nobs=nobs, nbins=nbins),
+                   lambda M_short=M_short, nbins=nbins: np.array(impl.calcMI(M_short[:, (0, 1)], nbins)))
+            yield ('calcTE', dict(nobs=nobs, nbins=nbins),
+                   lambda M=M, nbins=nbins: np.array(impl.calcTE(M, 1, nbins)))
+            crit = dict(alpha=alpha, numiter=numiter, seed=seed)
+            yield ('calcMI_crit', dict(nobs=nobs, nbins=nbins, **crit),
+                   lambda M_short=M_short, nbins=nbins: np.array(impl.calcMI_crit(
+                       M_short[:, (0, 1)], nbins, **crit)))
+            yield ('calcTE_crit', dict(nobs=nobs, nbins=nbins, **crit),
+                   lambda M=M, nbins=nbins: np.array(impl.calcTE_crit(M, 1, nbins, **crit)))
+            yield ('calc_it_lags', dict(nobs=nobs, nbins=nbins, n_lags=crit_n_lags, **crit),
+                   lambda M=M, nbins=nbins: _stack_metrics(
+                       impl.calc_it_lags(M, crit_n_lags, nbins, **crit),
+                       ['MI', 'MIcrit', 'TE', 'TEcrit', 'corr']))
+            yield ('calc_it_metrics', dict(nobs=nobs, nbins=nbins, n_lags=crit_n_lags, **crit),
+                   lambda M=M, Mswap=Mswap, nbins=nbins: _stack_metrics(
+                       impl.calc_it_metrics(M, Mswap, crit_n_lags, nbins, **crit),
+                       ['MI', 'MIcrit', 'TE', 'TEcrit', 'TEswap', 'TEcritswap', 'corr']))
+            for n_lags in n_lags_list:
+                yield ('calc_it_lags', dict(nobs=nobs, nbins=nbins, n_lags=n_lags),
+                       lambda M=M, nbins=nbins, n_lags=n_lags: _stack_metrics(
+                           impl.calc_it_lags(M, n_lags, nbins), ['MI', 'TE', 'corr']))
+                yield ('calc_it_metrics', dict(nobs=nobs, nbins=nbins, n_lags=n_lags),
+                       lambda M=M, Mswap=Mswap, nbins=nbins, n_lags=n_lags: _stack_metrics(
+                           impl.calc_it_metrics(M, Mswap, n_lags, nbins, alpha=None),
+                           ['MI', 'TE', 'TEswap', 'corr']))
+
+
+def _stack_metrics(it_metrics, keys):
+    return np.stack([np.asarray(it_metrics[key], dtype=float) for key in keys])
+
+
+def _case_key(name, params):
+    return name + '|' + ','.join(f'{k}={v}' for k, v in params.items())
+
+
+def _as_arrays(result):
+    if isinstance(result, tuple):
+        return [np.asarray(r) for r in result]
+    return [np.asarray(result)]
+
+
+def freeze_baselines(baseline_file=BASELINE_FILE, **case_kwargs):
+    """
+    write the result of every hot path case, computed with the reference
+    functions (see ReferenceImplementation), to baseline_file
+    """
+    impl = ReferenceImplementation()
+    baselines = {}
+    for name, params, func in hot_path_cases(impl, **case_kwargs):
+        for i, arr in enumerate(_as_arrays(func())):
+            baselines[f'{_case_key(name, params)}|{i}'] = arr
+    np.savez_compressed(baseline_file, **baselines)
+    return baseline_file
+
+
+def matches_baseline(baselines, name, params, result):
+    """
+    returns True/False if the result matches its frozen baseline, or None if
+    there is no baseline for the case
+    """
+    arrays = _as_arrays(result)
+    keys = [f'{_case_key(name, params)}|{i}' for i in range(len(arrays))]
+    if not all(key in baselines for key in keys):
+        return None
+    return all(np.allclose(arr, baselines[key], rtol=1e-10, atol=1e-12, equal_nan=True)
+               for key, arr in zip(keys, arrays))
+
+
+def benchmark_hot_paths(baseline_file=BASELINE_FILE, number=5, **case_kwargs):
+    """
+    time every hot path case and check its result against the frozen baselines
+    """
+    baselines = {}
+    if os.path.exists(baseline_file):
+        with np.load(baseline_file) as f:
+            baselines = dict(f)
+    rows = []
+    for name, params, func in hot_path_cases(**case_kwargs):
+        rows.append({'function': name,
+                     'case': ','.join(f'{k}={v}' for k, v in params.items()),
+                     'ms': time_it(func, number)*1e3,
+                     'matches_baseline': matches_baseline(baselines, name, params, func())})
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--freeze', action='store_true',
+                        help='write the results of the reference commit as the new baselines')
+    parser.add_argument('--reference', action='store_true',
+                        help='also benchmark against the np.histogramdd versions')
+    parser.add_argument('--number', type=int, default=5,
+                        help='number of calls per timing')
+    args = parser.parse_args()
+
+    if args.freeze:
+        print(f'wrote {freeze_baselines()}')
+    results = benchmark_hot_paths(number=args.number)
+    print(results.to_string(index=False, float_format='%.3f'))
+    if args.reference:
+        print(benchmark_pdfs().to_string(index=False, float_format='%.3f'))
+    if not results['matches_baseline'].fillna(True).all():
+        raise SystemExit('results differ from the frozen baselines')
@@ -4,6 +4,10 @@ Created on Fri May 27 10:00:43 2022
 
 @author: ggorski
 """
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import multiprocessing
+import os
 import pandas as pd
 import sys
 #sys.path.insert(0, 'C:\\Users\\ggorski\\OneDrive - DOI\\USGS_ML\\DO\\drb-do-ml\\scratch\\Functional_Performance\\src')
@@ -12,6 +16,46 @@ import numpy as np
 import math
 import xarray as xr
 
+
+@lru_cache(maxsize=32)
+def _read_site_io(inputs_zarr, site):
+    inputs = xr.open_zarr(inputs_zarr, consolidated=False)
+    return inputs.sel(site_id=site).to_dataframe()
+
+
+def get_site_io(inputs_zarr, site):
+    '''
+    Read the inputs and targets of one site from the io zarr. Only the data for
+    the site is read and the result is cached by zarr path and site, so repeated
+    calls from the same process (e.g., the func_perf jobs that snakemake runs for
+    every source, sink and replicate of a site) don't re-read the zarr
+
+    Parameters
+    ----------
+    inputs_zarr : str
+        path to io zarr file
+    site : str
+        site number
+
+    Returns
+    -------
+    pandas DataFrame of the site's data indexed by date (a copy, so it can be
+    modified by the caller)
+
+    '''
+    return _read_site_io(os.path.abspath(inputs_zarr), site).copy()
+
+
+# the inputs that calc_it_metrics_site considers as sources
+IT_SOURCES = ['CAT_BASIN_SLOPE', 'CAT_CNPY11_BUFF100', 'CAT_ELEV_MEAN',
+              'CAT_IMPV11', 'CAT_TWI', 'SLOPE', 'day.length', 'depth',
+              'discharge', 'light_ratio', 'model_confidence', 'pr',
+              'resolution', 'rmax', 'rmin', 'shortwave', 'site_min_confidence',
+              'site_name', 'sph', 'srad', 'temp.water', 'tmmn', 'tmmx',
+              'velocity', 'vs']
+IT_SINKS = ['do_min', 'do_mean', 'do_max', 'do_range']
+
+
 def calc_it_metrics_site(inputs_zarr,
                          predictions_file,
                          source,
@@ -20,7 +64,9 @@ def calc_it_metrics_site(inputs_zarr,
                          log_transform,
                          model,
                          replicate,
-                         outfile=None):
+                         outfile=None,
+                         binning='equal',
+                         seed=None):
     '''
     Calculate the transfer entropy (TE) and Mutual Information (MI) between
     one input (source) and one output (sink) at one site and one replicate
@@ -29,8 +75,8 @@ def calc_it_metrics_site(inputs_zarr,
     ----------
     inputs_zarr : str
         path to io zarr file
-    predictions_file : str
-        path to preds.feather file
+    predictions_file : str or pandas DataFrame
+        path to preds.feather file or the predictions already read from it
     source : str
         source for calculations (e.g., srad, tmmx, tmmn)
     sink : str
@@ -45,30 +91,34 @@ def calc_it_metrics_site(inputs_zarr,
         which replicate you are doing the calcs for
     outfile: str
         filepath to store the output (if desired)
+    binning: str
+        'equal' for equal width bins, with the outliers removed first, or
+        'quantile' for equiprobable bins, which the outliers can't empty, so
+        nothing is removed (see it_functions.calc_bin_codes)
+    seed: int
+        seed for the random number generator of the shuffled surrogates that
+        the significance thresholds come from, with a seed the thresholds are
+        the same on every run
         
     Returns
     -------
     Information theory metric results (transfer entropy) as a nested dictionary
 
     '''
-    inputs = xr.open_zarr(inputs_zarr, consolidated=False)
-    inputs_df = inputs.to_dataframe()
+    inputs_df_site = get_site_io(inputs_zarr, site)
     
-    # TODO: it'd be nice to read this in dynamically at some point
-    inputs_site = inputs_df.loc[site][['CAT_BASIN_SLOPE', 'CAT_CNPY11_BUFF100',
-           'CAT_ELEV_MEAN', 'CAT_IMPV11', 'CAT_TWI', 'SLOPE', 'day.length', 'depth',
-           'discharge', 'light_ratio',
-           'model_confidence', 'pr', 'resolution', 'rmax', 'rmin', 'shortwave',
-           'site_min_confidence', 'site_name', 'sph', 'srad', 'temp.water', 'tmmn',
-           'tmmx', 'velocity', 'vs']]
-    targets_site = inputs_df.loc[site][['do_min','do_mean','do_max']]
+    inputs_site = inputs_df_site[IT_SOURCES]
+    targets_site = inputs_df_site[['do_min','do_mean','do_max']]
     
     if sink == 'do_range':
         targets_site['do_range'] = targets_site['do_max']-targets_site['do_min']
         
     tar_dict = {}
 
-    model_preds = pd.read_feather(predictions_file)
+    if isinstance(predictions_file, pd.DataFrame):
+        model_preds = predictions_file
+    else:
+        model_preds = pd.read_feather(predictions_file)
     model_preds = model_preds[model_preds['site_id'] == site].set_index('date')[['do_min','do_mean','do_max']]
     model_preds['do_range'] = model_preds['do_max']-model_preds['do_min']
     #create targets dictionary
@@ -123,14 +173,18 @@ def calc_it_metrics_site(inputs_zarr,
     #Mswap is for caclulating the TE from Y -> X, we don't really need to do that
     #because DO doesn't affect solar radiation, but it is needed for function
     Mswap = np.stack((y_prepped, x_ss), axis = 1)
-    #x_bounds and y_bounds are for removing outliers
-    x_bounds = it_functions.find_bounds(M[:,0], 0.1, 99.9)
-    y_bounds = it_functions.find_bounds(M[:,1], 0.1, 99.9)
-    M_x_bound = np.delete(M, np.where((M[:,0] < x_bounds[0]*1.1) | (M[:,0] > x_bounds[1]*1.1)), axis = 0)
-    M_xy_bound = np.delete(M_x_bound, np.where((M_x_bound[:,1] < y_bounds[0]*1.1) | (M_x_bound[:,1] > y_bounds[1]*1.1)), axis = 0)
+    if binning == 'quantile':
+        M_xy_bound = M
+    else:
+        #x_bounds and y_bounds are for removing outliers
+        x_bounds = it_functions.find_bounds(M[:,0], 0.1, 99.9)
+        y_bounds = it_functions.find_bounds(M[:,1], 0.1, 99.9)
+        M_x_bound = np.delete(M, np.where((M[:,0] < x_bounds[0]*1.1) | (M[:,0] > x_bounds[1]*1.1)), axis = 0)
+        M_xy_bound = np.delete(M_x_bound, np.where((M_x_bound[:,1] < y_bounds[0]*1.1) | (M_x_bound[:,1] > y_bounds[1]*1.1)), axis = 0)
 
     #calc it metrics and store in the dictionary it_dict
-    it_dict = it_functions.calc_it_metrics(M_xy_bound, Mswap, n_lags, nbins, calc_swap = False, alpha = 0.05, ncores = 1)
+    it_dict = it_functions.calc_it_metrics(M_xy_bound, Mswap, n_lags, nbins, calc_swap = False, alpha = 0.05,
+                                           binning = binning, seed = seed)
     
     
     print('Storing it metrics '+model+' '+site)
@@ -180,3 +234,386 @@ def calc_it_metrics_site(inputs_zarr,
     return max_it
 
 
+
+
+def _calc_it_metrics_site_all(inputs_zarr, site_preds, site, sources, sinks,
+                              log_transform, model, replicate, binning, seed):
+    return [calc_it_metrics_site(inputs_zarr, site_preds, source, sink, site,
+                                 log_transform, model, replicate, binning=binning,
+                                 seed=seed)
+            for source in sources for sink in sinks]
+
+
+def calc_it_metrics_replicate(inputs_zarr,
+                              predictions_file,
+                              sites,
+                              sources,
+                              sinks,
+                              log_transform,
+                              model,
+                              replicate,
+                              holdout,
+                              outfile=None,
+                              n_workers=None,
+                              binning='equal',
+                              seed=None):
+    '''
+    Calculate the information theory metrics of calc_it_metrics_site for every
+    site, source and sink of one replicate in a single call. The predictions are
+    read once and each site is handled by one worker of a process pool, so the
+    site's io data is only read once for all of its sources and sinks
+
+    Parameters
+    ----------
+    inputs_zarr : str
+        path to io zarr file
+    predictions_file : str
+        path to preds.feather file
+    sites : list of str
+        site numbers
+    sources : list of str
+        sources for calculations (e.g., srad, tmmx, tmmn)
+    sinks : list of str
+        sinks for calculations (e.g., 'do_min', 'do_mean', 'do_max')
+    log_transform : boolean
+        should the source variable be log10 transformed, should only be log10 transformed for discharge
+    model: str
+        the model for which you are doing the calcs (e.g., '0_baseline_LSTM', 'observed')
+    replicate: int
+        which replicate you are doing the calcs for
+    holdout: str
+        which holdout the replicate belongs to, stored in a 'holdout' column
+    outfile: str
+        filepath to store the output as a parquet file (if desired)
+    n_workers: int
+        number of worker processes, defaults to the number of cpus
+    binning: str
+        'equal' or 'quantile' bins, see calc_it_metrics_site
+    seed: int
+        seed for the random number generator of the surrogates, see
+        calc_it_metrics_site
+
+    Returns
+    -------
+    pandas DataFrame with one row per site, source and sink
+
+    '''
+    preds = pd.read_feather(predictions_file)
+
+    # spawn the workers so they don't inherit the state of a parent that has
+    # already started threads (e.g., snakemake or tensorflow)
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx) as pool:
+        futures = [pool.submit(_calc_it_metrics_site_all,
+                               inputs_zarr,
+                               preds[preds['site_id'] == site],
+                               site,
+                               sources,
+                               sinks,
+                               log_transform,
+                               model,
+                               replicate,
+                               binning,
+                               seed)
+                   for site in sites]
+        max_it_list = [max_it for future in futures for max_it in future.result()]
+
+    df = pd.DataFrame(max_it_list)
+    df['holdout'] = holdout
+
+    if outfile:
+        df.to_parquet(outfile, index=False)
+
+    return df
+
+
+def prep_site_source_sink(inputs_zarr,
+                          predictions_file,
+                          source,
+                          sink,
+                          site,
+                          log_transform,
+                          model,
+                          remove_outliers=True):
+    '''
+    Prepare one source and one sink of a site the same way calc_it_metrics_site
+    does (log transform, seasonal signal removal and standardization), except
+    that the outliers are set to nan instead of being dropped, so the rows stay
+    consecutive days
+
+    Parameters
+    ----------
+    inputs_zarr : str
+        path to io zarr file
+    predictions_file : str or pandas DataFrame
+        path to preds.feather file or the predictions already read from it
+    source : str
+        source for calculations (e.g., srad, tmmx, tmmn)
+    sink : str
+        sink for calculations (e.g., 'do_min', 'do_mean', 'do_max', 'do_range')
+    site : str
+        site number
+    log_transform : boolean
+        should the source variable be log10 transformed
+    model: str
+        the model whose predictions are the sink (e.g., '0_baseline_LSTM'), or
+        'observed' for the observations
+    remove_outliers : boolean
+        should the outliers be set to nan (see prep_it_series)
+
+    Returns
+    -------
+    numpy array of shape (ndates, 2) with the source and sink and the dates as
+    a pandas DatetimeIndex
+
+    '''
+    inputs_df_site = get_site_io(inputs_zarr, site)
+    if model == 'observed':
+        targets_site = inputs_df_site[['do_min', 'do_mean', 'do_max']].copy()
+    else:
+        if isinstance(predictions_file, pd.DataFrame):
+            model_preds = predictions_file
+        else:
+            model_preds = pd.read_feather(predictions_file)
+        model_preds = model_preds[model_preds['site_id'] == site]
+        targets_site = model_preds.set_index('date')[['do_min', 'do_mean', 'do_max']]
+        targets_site.index = pd.DatetimeIndex(targets_site.index)
+    targets_site['do_range'] = targets_site['do_max'] - targets_site['do_min']
+
+    site_inptar = inputs_df_site[[source]].join(targets_site[[sink]])
+    x = site_inptar[source]
+    y = site_inptar[sink]
+
+    M = np.stack((prep_it_series(x, log_transform, remove_outliers),
+                  prep_it_series(y, remove_outliers=remove_outliers)), axis=1)
+    return M, site_inptar.index
+
+
+def prep_it_series(sr, log_transform=False, remove_outliers=True):
+    '''
+    Prepare one series for the information theory calculations: log transform
+    (optional), remove the seasonal signal, standardize and set the outliers
+    (outside the bounds used by calc_it_metrics_site) to nan
+
+    Parameters
+    ----------
+    sr : pandas Series
+        daily values with a DatetimeIndex
+    log_transform : boolean
+        should the series be log10 transformed
+    remove_outliers : boolean
+        should the outliers be set to nan, not needed with quantile bins
+
+    Returns
+    -------
+    numpy array the same length as sr
+
+    '''
+    ppf = it_functions.pre_proc_func()
+    if log_transform:
+        sr = ppf.log10(sr)
+    prepped = np.array(ppf.standardize(ppf.remove_seasonal_signal(sr)), dtype=float)
+    if not remove_outliers:
+        return prepped
+    bounds = it_functions.find_bounds(prepped, 0.1, 99.9)
+    with np.errstate(invalid='ignore'):
+        outlier = (prepped < bounds[0]*1.1) | (prepped > bounds[1]*1.1)
+    prepped[outlier] = np.nan
+    return prepped
+
+
+def calc_it_windows_site(inputs_zarr,
+                         predictions_file,
+                         source,
+                         sink,
+                         site,
+                         log_transform,
+                         model,
+                         window=365,
+                         step=30,
+                         n_lags=9,
+                         nbins=11,
+                         outfile=None,
+                         binning='equal'):
+    '''
+    Calculate time resolved transfer entropy (TE) and mutual information (MI)
+    between one source and one sink at one site, in windows that move over the
+    whole record (see it_functions.calc_it_windows)
+
+    Parameters
+    ----------
+    inputs_zarr : str
+        path to io zarr file
+    predictions_file : str or pandas DataFrame
+        path to preds.feather file or the predictions already read from it
+    source : str
+        source for calculations (e.g., srad, tmmx, tmmn)
+    sink : str
+        sink for calculations (e.g., 'do_min', 'do_mean', 'do_max', 'do_range')
+    site : str
+        site number
+    log_transform : boolean
+        should the source variable be log10 transformed
+    model: str
+        the model for which you are doing the calcs (e.g., '0_baseline_LSTM', 'observed')
+    window : int
+        number of days in each window
+    step : int
+        number of days the window moves each time
+    n_lags : int
+        number of time lags, from 0 to n_lags - 1
+    nbins : int
+        number of bins used for estimating the pdfs
+    outfile: str
+        filepath to store the output as a netcdf file (if desired)
+    binning: str
+        'equal' bins (outliers set to nan) or 'quantile' bins (outliers kept)
+
+    Returns
+    -------
+    xarray Dataset of TE, MI and n (the number of triplets used) with
+    dimensions (window_start, lag)
+
+    '''
+    M, dates = prep_site_source_sink(inputs_zarr, predictions_file, source,
+                                     sink, site, log_transform, model,
+                                     remove_outliers=binning == 'equal')
+    it_windows = it_functions.calc_it_windows(M, n_lags, nbins, window, step=step,
+                                              binning=binning)
+
+    dims = ['window_start', 'lag']
+    ds = xr.Dataset({var: (dims, it_windows[var]) for var in ['TE', 'MI', 'n']},
+                    coords={'window_start': dates[it_windows['start']].values,
+                            'lag': np.arange(n_lags)})
+    ds['window_end'] = ('window_start', dates[it_windows['start'] + window - 1].values)
+    ds.attrs.update(site=site, source=source, sink=sink, model=model,
+                    window=window, step=step, nbins=nbins, binning=binning)
+
+    if outfile:
+        ds.to_netcdf(outfile)
+
+    return ds
+
+
+def calc_it_network_site(inputs_zarr,
+                         predictions_file,
+                         site,
+                         model,
+                         sources=None,
+                         sinks=None,
+                         log_transform_sources=('discharge',),
+                         n_lags=9,
+                         nbins=11,
+                         outfile=None,
+                         binning='equal',
+                         alpha=None,
+                         numiter=500,
+                         seed=None):
+    '''
+    Calculate the MI, TE and correlation lag curves between every source
+    (input variable) and every DO sink at one site, for the observations and
+    the predictions of a model. Each series is prepared and binned once and
+    reused for all of its pairs (see it_functions.calc_it_network)
+
+    Parameters
+    ----------
+    inputs_zarr : str
+        path to io zarr file
+    predictions_file : str or pandas DataFrame
+        path to preds.feather file or the predictions already read from it
+    site : str
+        site number
+    model: str
+        the model whose predictions are used as sinks along with the
+        observations (e.g., '0_baseline_LSTM'), or 'observed' for the
+        observations only
+    sources : list of str
+        sources, defaults to IT_SOURCES. Sources that aren't numeric or
+        have fewer than 2 distinct values at the site are left out
+    sinks : list of str
+        sinks, defaults to IT_SINKS
+    log_transform_sources : tuple of str
+        sources that are log10 transformed
+    n_lags : int
+        number of time lags, from 0 to n_lags - 1
+    nbins : int
+        number of bins used for estimating the pdfs
+    outfile: str
+        filepath to store the output as a parquet file (if desired)
+    binning: str
+        'equal' bins (outliers set to nan) or 'quantile' bins (outliers kept)
+    alpha: float
+        significance threshold, if given the critical thresholds of MI and TE
+        (MIcrit and TEcrit) are calculated from numiter shuffled surrogates
+    numiter: int
+        number of surrogates for the critical thresholds
+    seed: int
+        seed for the random number generator of the surrogates, with a seed
+        the thresholds are the same on every run
+
+    Returns
+    -------
+    pandas DataFrame with one row per model (observed or the model), source,
+    sink and lag. Empty if none of the sources vary at the site
+
+    '''
+    sources = sources or IT_SOURCES
+    sinks = sinks or IT_SINKS
+    inputs_df_site = get_site_io(inputs_zarr, site)
+
+    targets = {'observed': inputs_df_site[['do_min', 'do_mean', 'do_max']].copy()}
+    if model != 'observed':
+        if isinstance(predictions_file, pd.DataFrame):
+            model_preds = predictions_file
+        else:
+            model_preds = pd.read_feather(predictions_file)
+        model_preds = model_preds[model_preds['site_id'] == site]
+        model_preds = model_preds.set_index('date')[['do_min', 'do_mean', 'do_max']]
+        model_preds.index = pd.DatetimeIndex(model_preds.index)
+        targets[model] = model_preds.reindex(inputs_df_site.index)
+    for target in targets.values():
+        target['do_range'] = target['do_max'] - target['do_min']
+
+    sources = [source for source in sources
+               if pd.api.types.is_numeric_dtype(inputs_df_site[source])
+               and inputs_df_site[source].notna().any()]
+    remove_outliers = binning == 'equal'
+    prepped = {source: prep_it_series(inputs_df_site[source],
+                                      log_transform=source in log_transform_sources,
+                                      remove_outliers=remove_outliers)
+               for source in sources}
+    # a source that is constant at the site (e.g., the CAT_* catchment
+    # attributes) is all nan once it's standardized and carries no information
+    sources = [source for source in sources
+               if np.unique(prepped[source][~np.isnan(prepped[source])]).size >= 2]
+    if not sources:
+        metrics = ['MI', 'TE', 'corr']
+        if alpha is not None:
+            metrics = ['MI', 'MIcrit', 'TE', 'TEcrit', 'corr']
+        df = pd.DataFrame(columns=['model', 'source', 'sink', 'lag'] + metrics + ['site'])
+        if outfile:
+            df.to_parquet(outfile, index=False)
+        return df
+    X = np.stack([prepped[source] for source in sources], axis=1)
+
+    networks = []
+    for target_model, target in targets.items():
+        Y = np.stack([prep_it_series(target[sink], remove_outliers=remove_outliers)
+                      for sink in sinks], axis=1)
+        network = it_functions.calc_it_network(X, Y, n_lags, nbins,
+                                               source_names=sources,
+                                               sink_names=sinks,
+                                               alpha=alpha,
+                                               numiter=numiter,
+                                               binning=binning,
+                                               seed=seed)
+        network.insert(0, 'model', target_model)
+        networks.append(network)
+    df = pd.concat(networks, ignore_index=True)
+    df['site'] = site
+
+    if outfile:
+        df.to_parquet(outfile, index=False)
+
+    return df
+
@@ -12,10 +12,9 @@ These functions were developed borrowing code and ideas from:
 
 """
 
-from joblib import Parallel, delayed
 import math
 import numpy as np
-import os
+import pandas as pd
 from scipy.stats import pearsonr
 
 #%%
@@ -41,27 +40,33 @@ class pre_proc_func:
         anomaly = sr - np.nanmean(sr)
         return anomaly
 
-    def remove_seasonal_signal(self, sr):
+    def remove_seasonal_signal(self, sr, window = None):
+        '''removes the seasonal signal (the day of year means) from sr
+        sr: pandas series with a DatetimeIndex
+        window: if given, the day of year means are smoothed with a centered moving
+        window of this many days that wraps around the end of the year
+        returns a numpy array the same length as sr, nan values are kept'''
         #calculate doy for sr
-        sr_doy = sr.index.strftime('%j')
-        #convert sr_historical to df
-        sr_historical_df = sr.to_frame().copy()
-        #calculate doy
-        sr_historical_df['doy'] = list(sr.index.strftime('%j'))
-        #calculate the doy means
-        doy_means = sr_historical_df.groupby('doy').mean()
-        #convert the index (doy) to int64
-        doy_means.index = doy_means.index.astype('int64')
-        seasonal_removed = list()
-        for i in range(len(sr)):
-            if math.isnan(sr[i]):
-                seasonal_removed.append(np.nan)
-            else:
-                doy = int(sr_doy[i])
-                doy_mean = doy_means.loc[doy]
-                value = sr.iloc[i]-doy_mean[0]
-                seasonal_removed.append(value)
-        return seasonal_removed
+        doy = sr.index.dayofyear.values
+        if window is None:
+            #calculate the doy means
+            doy_means = sr.groupby(doy).transform('mean').values
+            return sr.values - doy_means
+        
+        #sums and counts of the non-nan values for each doy (1-366)
+        doy_stats = sr.groupby(doy).agg(['sum', 'count']).reindex(range(1, 367), fill_value = 0)
+        half = window//2
+        kernel = np.ones(window)
+        smoothed = {}
+        for stat in ['sum', 'count']:
+            #pad both ends so that the window wraps around the end of the year
+            padded = np.concatenate((doy_stats[stat].values[-half:],
+                                     doy_stats[stat].values,
+                                     doy_stats[stat].values[:window - 1 - half]))
+            smoothed[stat] = np.convolve(padded, kernel, mode = 'valid')
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            doy_means = smoothed['sum']/smoothed['count']
+        return sr.values - doy_means[doy - 1]
     
 def find_bounds(data, lower,upper):
     '''
@@ -91,14 +96,28 @@ def find_bounds(data, lower,upper):
         return np.nanpercentile(data, lower), None
     return np.nanpercentile(data, lower), np.nanpercentile(data, upper)
 
-def calc2Dpdf(M,nbins):
+def calc_bin_codes(M, nbins, binning = 'equal'):
+    '''discretizes each column of M into integer bin codes, so that the data only has to
+    be binned once and pdfs can be counted from the codes (see calc2Dpdf and calc3Dpdfs).
+    M: a numpy array of shape (nobs, ncols) where nobs is the number of observations,
+    M should not have any nan values
+    nbins: is the number of bins used for estimating the pdf
+    binning: 'equal' for the same equal width bins used by np.histogramdd(M, bins = nbins),
+    or 'quantile' for equiprobable bins that each hold (about) nobs/nbins of the values
+    returns an integer array of shape (nobs, ncols) with values from 0 to nbins-1'''
+    #each column is binned as a contiguous row, binning a strided view is several times slower
+    return _series_codes(np.ascontiguousarray(M.T), nbins, binning).T
+
+def calc2Dpdf(M,nbins, binning = 'equal'):
     '''calculates the 3 pdfs, one for x, one for y and a joint pdf for x and y 
     M: a numpy array of shape (nobs, 2) where nobs is the number of observations
     this assumes that the data are arrange such that the first column is the source (x) and
     the second column is the sink (y).
-    nbins: is the number of bins used for estimating the pdf '''
+    nbins: is the number of bins used for estimating the pdf 
+    binning: 'equal' (equal width) or 'quantile' (equiprobable) bins, see calc_bin_codes'''
     
-    counts, binEdges = np.histogramdd(M,bins=nbins)
+    codes = calc_bin_codes(M, nbins, binning)
+    counts = _joint_counts([codes[:,0], codes[:,1]], nbins)
     p_xy = counts/np.sum(counts)
     
     p_x = np.sum(p_xy,axis=1)
@@ -106,15 +125,22 @@ def calc2Dpdf(M,nbins):
     
     return p_x, p_y, p_xy
 
-def calc3Dpdfs(M, nbins):
+def calc3Dpdfs(M, nbins, binning = 'equal', sparse = False):
     '''calculates the 7 pdfs, one each for x, y, and z, one each for their individual
     joint distributions, and one for the 3d joint distributions. Right now it only returns
     the 3d joint distribution for simplicity
     M: a numpy array of shape (nobs, 3) where nobs is the number of observations.
-    nbins: is the number of bins used for estimating the pdf '''
-    # use numpy histogram as pdf
-    pdf,edges = np.histogramdd(M,bins=nbins)
-    p_xyz = pdf/np.sum(pdf)
+    nbins: is the number of bins used for estimating the pdf 
+    binning: 'equal' (equal width) or 'quantile' (equiprobable) bins, see calc_bin_codes
+    sparse: boolean, if True only the non-empty cells are returned, as a tuple of their
+    flat index into the (nbins, nbins, nbins) pdf and their probabilities, instead of
+    the dense nbins**3 array (see _sparse_joint_counts)'''
+    codes = calc_bin_codes(M, nbins, binning)
+    if sparse:
+        cells, counts = _sparse_joint_counts([codes[:,0], codes[:,1], codes[:,2]], nbins)
+        return cells, counts/np.sum(counts)
+    counts = _joint_counts([codes[:,0], codes[:,1], codes[:,2]], nbins)
+    p_xyz = counts/np.sum(counts)
     
     #p_xy = np.sum(p_xyz,axis=2)
     #p_xz = np.sum(p_xyz,axis=1)
@@ -132,50 +158,301 @@ def calcEntropy(pdf):
     
     pdf_n_0 = pdf[pdf>0]
     log2_pdf_n_0 = np.log2(pdf_n_0)
-    H = (-sum(pdf_n_0*log2_pdf_n_0))
+    H = -np.sum(pdf_n_0*log2_pdf_n_0)
+    return H
+
+#c*log2(c) for the small counts that make up most of the histograms, built on first use
+_CLOG2C_TABLE_SIZE = 2**14
+_clog2c_table = None
+
+def _clog2c(counts):
+    '''c*log2(c) of integer counts (0*log2(0) is 0), looked up in a table for counts
+    below _CLOG2C_TABLE_SIZE'''
+    global _clog2c_table
+    if _clog2c_table is None:
+        c = np.arange(_CLOG2C_TABLE_SIZE, dtype = float)
+        _clog2c_table = c*np.log2(np.maximum(c, 1))
+    if counts.size == 0 or counts.max() < _CLOG2C_TABLE_SIZE:
+        return _clog2c_table[counts]
+    small = counts < _CLOG2C_TABLE_SIZE
+    out = np.empty(counts.shape)
+    out[small] = _clog2c_table[counts[small]]
+    big = counts[~small].astype(float)
+    out[~small] = big*np.log2(big)
+    return out
+
+def calcEntropy_counts(counts, ndim = None):
+    '''calculate the entropy from integer histogram counts rather than a pdf
+    H = log2(N) - sum(c*log2(c))/N
+    where c*log2(c) comes from a lookup table, so there is no normalizing, masking or
+    log of the histogram
+    counts: an integer array of counts where the last ndim axes are the histogram, any
+    leading axes are treated as a stack (e.g. surrogates) and reduced in the same call
+    ndim: number of dimensions of the histogram, default is all of the axes of counts
+    returns the entropy, or an array of entropies with the shape of the leading axes'''
+    counts = np.asarray(counts)
+    if ndim is None:
+        ndim = counts.ndim
+    stack_shape = counts.shape[:counts.ndim - ndim]
+    flat = counts.reshape(stack_shape + (-1,))
+    if not np.issubdtype(flat.dtype, np.integer):
+        flat = flat.astype(np.int64)
+    N = np.sum(flat, axis = -1)
+    H = np.log2(N) - np.sum(_clog2c(flat), axis = -1)/N
     return H
 
+def _bin_codes(data, nbins):
+    '''discretizes data into integer bin codes along the last axis, using the same
+    equal width bins as np.histogramdd(M, bins = nbins) (edges span the min and max
+    of each series, the last bin is closed on the right)
+    data: a numpy array of shape (..., nobs) without nan values, each series along the
+    last axis gets its own bin edges
+    nbins: is the number of bins used for estimating the pdf
+    returns an integer array the same shape as data with values from 0 to nbins-1'''
+    if data.shape[-1] == 0:
+        #no values (e.g. a series that is all nan), nothing to bin
+        return np.zeros(data.shape, dtype = np.intp)
+    lo = np.min(data, axis = -1)
+    hi = np.max(data, axis = -1)
+    #histogramdd widens the range of a constant series by 0.5 on each side
+    same = lo == hi
+    lo = np.where(same, lo - 0.5, lo)
+    hi = np.where(same, hi + 0.5, hi)
+    edges = np.linspace(lo, hi, nbins + 1, axis = -1)
+    
+    codes = ((data - lo[..., None])*(nbins/(hi - lo))[..., None]).astype(np.intp)
+    np.clip(codes, 0, nbins - 1, out = codes)
+    #correct for round off so that the codes match a search on the bin edges,
+    #each series indexes its own row of the flattened edges
+    row = (np.arange(codes.size // data.shape[-1])*(nbins + 1)).reshape(data.shape[:-1] + (1,))
+    edges = edges.ravel()
+    codes -= data < edges[codes + row]
+    codes += (data >= edges[codes + row + 1]) & (codes < nbins - 1)
+    return codes
+
+def _quantile_codes(data, nbins):
+    '''discretizes data into equiprobable bins along the last axis: each value is coded
+    by its rank, so every bin holds about nobs/nbins values however skewed the series
+    or far out its outliers. Tied values share the bin of their lowest rank
+    data: a numpy array of shape (..., nobs) without nan values, each series along the
+    last axis is ranked on its own
+    nbins: is the number of bins used for estimating the pdf
+    returns an integer array the same shape as data with values from 0 to nbins-1'''
+    nobs = data.shape[-1]
+    if nobs == 0:
+        return np.zeros(data.shape, dtype = np.intp)
+    series = data.reshape(-1, nobs)
+    codes = np.empty(series.shape, dtype = np.intp)
+    for i, sr in enumerate(series):
+        sorted_sr = sr[np.argsort(sr, kind = 'stable')]
+        codes[i] = np.searchsorted(sorted_sr, sr, side = 'left')
+    codes *= nbins
+    codes //= nobs
+    return codes.reshape(data.shape)
+
+def _series_codes(data, nbins, binning = 'equal'):
+    '''bin codes of each series along the last axis of data with the given binning,
+    'equal' (see _bin_codes) or 'quantile' (see _quantile_codes)'''
+    if binning == 'equal':
+        return _bin_codes(data, nbins)
+    if binning == 'quantile':
+        return _quantile_codes(data, nbins)
+    raise ValueError(f"binning has to be 'equal' or 'quantile', not {binning!r}")
+
+def _joint_counts(codes, nbins):
+    '''counts the joint occurrences of a set of coded variables with a single bincount
+    codes: a list of integer arrays of shape (..., nobs), one per variable, as returned
+    by _bin_codes. Any leading dimensions are treated as a batch (e.g. surrogates)
+    nbins: is the number of bins used for estimating the pdf
+    returns an array of counts of shape (..., nbins, nbins, ...) with one nbins axis
+    per variable'''
+    ncols = len(codes)
+    flat = codes[0]
+    for c in codes[1:]:
+        flat = flat*nbins + c
+    batch_shape = flat.shape[:-1]
+    nbatch = int(np.prod(batch_shape))
+    size = nbins**ncols
+    #offset each member of the batch so that they can all be counted in one pass
+    offsets = (np.arange(nbatch)*size).reshape(batch_shape + (1,))
+    counts = np.bincount((flat + offsets).ravel(), minlength = nbatch*size)
+    return counts.reshape(batch_shape + (nbins,)*ncols)
+
+#joint counts are kept sparse when the dense histogram would have more than this many
+#cells per observation, i.e. when most of its cells would be empty
+_SPARSE_CELLS_PER_OBS = 16
+
+def _use_sparse(sparse, nbins, ncols, nobs):
+    '''should the joint counts be sparse, sparse = None decides from the number of cells'''
+    if sparse is None:
+        return nbins**ncols > _SPARSE_CELLS_PER_OBS*nobs
+    return sparse
+
+def _sparse_joint_counts(codes, nbins):
+    '''counts the joint occurrences of a set of coded variables, keeping only the cells
+    that occur, so the memory is bounded by the number of observations rather than nbins
+    to the power of the number of variables
+    codes: a list of integer arrays of shape (nobs,), one per variable, as returned by
+    _bin_codes or _quantile_codes
+    nbins: is the number of bins used for estimating the pdf
+    returns a tuple of the flat index of each non-empty cell (as in _joint_counts) and its
+    count'''
+    flat = codes[0]
+    for c in codes[1:]:
+        flat = flat*nbins + c
+    return np.unique(flat, return_counts = True)
+
+def _sparse_marginal(cells, counts, nbins, ndim, axes):
+    '''sums sparse joint counts over all of the axes that aren't in axes
+    cells, counts: as returned by _sparse_joint_counts
+    ndim: number of variables (axes) of the joint counts
+    axes: the axes that are kept, in order
+    returns the cells and counts of the marginal, in the same form'''
+    flat = (cells // nbins**(ndim - 1 - axes[0])) % nbins
+    for axis in axes[1:]:
+        flat = flat*nbins + (cells // nbins**(ndim - 1 - axis)) % nbins
+    marginal_cells, inverse = np.unique(flat, return_inverse = True)
+    return marginal_cells, np.bincount(inverse, weights = counts).astype(np.int64)
+
+def _calcMI_counts(counts_xy):
+    '''mutual information from the joint counts of x and y normalized by the entropy of y
+    counts_xy: array of shape (..., nbins, nbins), any leading dimensions are treated
+    as a batch'''
+    Hx = calcEntropy_counts(np.sum(counts_xy, axis = -1), 1)
+    Hy = calcEntropy_counts(np.sum(counts_xy, axis = -2), 1)
+    Hxy = calcEntropy_counts(counts_xy, 2)
+    return (Hx+Hy-Hxy)/Hy
+
+def _calcTE_counts(counts_xlyulyl):
+    '''transfer entropy from the joint counts of the lagged triplet H(Xt-T, Yt, Yt-T)
+    normalized by the entropy of the sink
+    counts_xlyulyl: array of shape (..., nbins, nbins, nbins), any leading dimensions are
+    treated as a batch'''
+    counts_xlyl = np.sum(counts_xlyulyl, axis = -2)
+    counts_yulyl = np.sum(counts_xlyulyl, axis = -3)
+    counts_yu = np.sum(counts_yulyl, axis = -1)
+    
+    T1 = calcEntropy_counts(counts_xlyl, 2)
+    T2 = calcEntropy_counts(counts_yulyl, 2)
+    T3 = calcEntropy_counts(counts_yu, 1)
+    T4 = calcEntropy_counts(counts_xlyulyl, 3)
+    return (T1+T2-T3-T4)/T3
+
+def _calcMI_sparse(cells, counts, nbins):
+    '''_calcMI_counts from the sparse joint counts of x and y (see _sparse_joint_counts)'''
+    Hx = calcEntropy_counts(_sparse_marginal(cells, counts, nbins, 2, (0,))[1])
+    Hy = calcEntropy_counts(_sparse_marginal(cells, counts, nbins, 2, (1,))[1])
+    Hxy = calcEntropy_counts(counts)
+    return (Hx+Hy-Hxy)/Hy
+
+def _calcTE_sparse(cells, counts, nbins):
+    '''_calcTE_counts from the sparse joint counts of the lagged triplet (see
+    _sparse_joint_counts)'''
+    T1 = calcEntropy_counts(_sparse_marginal(cells, counts, nbins, 3, (0, 2))[1])
+    T2 = calcEntropy_counts(_sparse_marginal(cells, counts, nbins, 3, (1, 2))[1])
+    T3 = calcEntropy_counts(_sparse_marginal(cells, counts, nbins, 3, (1,))[1])
+    T4 = calcEntropy_counts(counts)
+    return (T1+T2-T3-T4)/T3
+
+def _subset_codes(values, codes, index, nbins, binning = 'equal'):
+    '''bin codes of values[index], reusing the codes of the full series. The equal width
+    bin edges only depend on the min and max of a series, so a subset keeps the codes of
+    the full series unless it dropped the min or max value, only those are binned again.
+    The quantile bins are always those of the full series, so the codes are just indexed
+    values: numpy array of shape (nobs,) without nan values
+    codes: bin codes of values, as returned by _series_codes(values, nbins, binning)
+    index: integer array of shape (..., nsub) of positions in values
+    nbins: is the number of bins used for estimating the pdf
+    binning: 'equal' or 'quantile', the binning the codes were made with
+    returns an integer array of bin codes with the same shape as index'''
+    if binning == 'quantile' or index.shape[-1] == 0:
+        return codes[index]
+    subset = values[index]
+    subset_codes = codes[index]
+    rebin = ((np.min(subset, axis = -1) != np.min(values)) |
+             (np.max(subset, axis = -1) != np.max(values)))
+    if np.any(rebin):
+        subset_codes[rebin] = _bin_codes(subset[rebin], nbins)
+    return subset_codes
 
-def calcMI(M, nbins):
+def _shuffle_index(n, numiter, rng):
+    '''builds an index matrix of permutations
+    n: length of the series being shuffled
+    numiter: number of permutations
+    rng: numpy random generator
+    returns an integer array of shape (numiter, n), each row is a permutation of 0 to n-1'''
+    return rng.permuted(np.tile(np.arange(n, dtype = np.int32), (numiter, 1)), axis = 1)
+
+def _spawn_seeds(seed, n):
+    '''independent child seeds, e.g. one per lag or per source/sink pair, so that their
+    surrogates don't all come from the same permutations
+    seed: int, None or a numpy SeedSequence
+    n: number of child seeds
+    returns a list of n numpy SeedSequences (accepted as seed by np.random.default_rng)'''
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return seed.spawn(n)
+
+def calcMI(M, nbins, binning = 'equal', sparse = None):
     '''calculate mutual information of two variables
     M: a numpy array of shape (nobs, 2) where nobs is the number of observations
     this assumes that the data are arrange such that the first column is the source and
     the second column is the sink.
     nbins: is the number of bins used for estimating the pdf 
-    the mutual information is normalized by the entropy of the sink'''
-    
-    
-    p_x, p_y, p_xy = calc2Dpdf(M, nbins = nbins)
+    the mutual information is normalized by the entropy of the sink
+    binning: 'equal' (equal width) or 'quantile' (equiprobable) bins, see calc_bin_codes
+    sparse: boolean should the joint counts be sparse (see _sparse_joint_counts), the
+    default (None) uses sparse counts when most of the nbins**2 cells would be empty'''
     
-    Hx = calcEntropy(p_x)
-    Hy = calcEntropy(p_y)
-    Hxy = calcEntropy(p_xy)
     
-    MI = (Hx+Hy-Hxy)/Hy
+    codes = calc_bin_codes(M, nbins, binning)
+    codes = [codes[:,0], codes[:,1]]
+    if _use_sparse(sparse, nbins, 2, M.shape[0]):
+        return _calcMI_sparse(*_sparse_joint_counts(codes, nbins), nbins)
+    MI = _calcMI_counts(_joint_counts(codes, nbins))
     
     return MI
 
-def calcMI_shuffled(M, nbins):
-    '''shuffles the input dataset to destroy temporal relationships for signficance testing
+def calcMI_surrogates(M, nbins, numiter = 500, seed = None, chunk_size = 100,
+                      binning = 'equal'):
+    '''calculate the mutual information of shuffled surrogates of M for significance testing.
+    Each column is shuffled separately (only between its non-nan positions), and all of the
+    permutations are built at once as an index matrix and binned and counted in one pass
     M: a numpy array of shape (nobs, 2) where nobs is the number of observations
     this assumes that the data are arrange such that the first column is the source and
     the second column is the sink.
     nbins: is the number of bins used for estimating the pdf 
-    the mutual information is normalized by the entropy of the sink
-    returns a single MI value for a numpy array the same size and shape as M, 
-    but with the order shuffled'''
-    
-    Mss = np.ones(np.shape(M))*np.nan # Initialize
-    
-    for n in range(np.shape(M)[1]): # Columns are shuffled separately
-        n_nans = np.argwhere(~np.isnan(M[:,n]))
-        R = np.random.rand(np.shape(n_nans)[0],1)
-        I = np.argsort(R,axis=0)
-        Mss[n_nans[:,0],n] = M[n_nans[I[:],0],n].reshape(np.shape(M[n_nans[I[:],0],n])[0],)
-    MI_shuff = calcMI(Mss, nbins = nbins)
-    return MI_shuff
-    
-def calcMI_crit(M, nbins, alpha, ncores, numiter = 500):
+    numiter: number of surrogates, default = 500
+    seed: seed for the random number generator
+    chunk_size: number of surrogates that are held in memory at one time
+    binning: 'equal' (equal width) or 'quantile' (equiprobable) bins, see calc_bin_codes
+    returns an array of shape (numiter,) of MI values'''
+    rng = np.random.default_rng(seed)
+    valid_x = ~np.isnan(M[:,0])
+    valid_y = ~np.isnan(M[:,1])
+    #shuffling only moves values between non-nan positions, so the rows with a nan
+    #value are the same for every surrogate
+    keep = valid_x & valid_y
+    #rank of each kept position among the non-nan positions of each column
+    rank_x = np.cumsum(valid_x)[keep] - 1
+    rank_y = np.cumsum(valid_y)[keep] - 1
+    #the non-nan values of each column and their codes are the same for every surrogate
+    x = M[valid_x, 0]
+    y = M[valid_y, 1]
+    codes_x = _series_codes(x, nbins, binning)
+    codes_y = _series_codes(y, nbins, binning)
+    
+    MIss = []
+    for start in range(0, numiter, chunk_size):
+        n = min(chunk_size, numiter - start)
+        I_x = _shuffle_index(x.size, n, rng)
+        I_y = _shuffle_index(y.size, n, rng)
+        codes = [_subset_codes(x, codes_x, I_x[:, rank_x], nbins, binning),
+                 _subset_codes(y, codes_y, I_y[:, rank_y], nbins, binning)]
+        MIss.append(_calcMI_counts(_joint_counts(codes, nbins)))
+    return np.concatenate(MIss)
+    
+def calcMI_crit(M, nbins, alpha, numiter = 500, seed = None, binning = 'equal'):
     '''calculate the critical threshold of mutual information
     M: a numpy array of shape (nobs, 2) where nobs is the number of observations
     this assumes that the data are arrange such that the first column is the source and
@@ -183,17 +460,44 @@ def calcMI_crit(M, nbins, alpha, ncores, numiter = 500):
     nbins: is the number of bins used for estimating the pdf 
     the mutual information is normalized by the entropy of the sink
     alpha: significance threshold
-    ncores: number of cores
     numiter: number of iterations, default = 500
+    seed: seed for the random number generator
+    binning: 'equal' (equal width) or 'quantile' (equiprobable) bins, see calc_bin_codes
     '''
-    return 0
-    # assert ncores < os.cpu_count()
-    
-    # MIss = Parallel(n_jobs=ncores)(delayed(calcMI_shuffled)(M, nbins) for ii in range(numiter))
-    # MIss = np.sort(MIss)
-    # print(MIss)
-    # MIcrit = MIss[math.ceil((1-alpha)*numiter)] 
-    # return(MIcrit)
+    MIss = np.sort(calcMI_surrogates(M, nbins, numiter = numiter, seed = seed,
+                                     binning = binning))
+    MIcrit = MIss[min(math.ceil((1-alpha)*numiter), numiter - 1)]
+    return MIcrit
+
+def _calcMI_crit_codes(codes_x, codes_y, nbins, alpha, numiter = 500, seed = None,
+                       chunk_size = 100):
+    '''calcMI_crit from the bin codes of two series without nan values, the surrogates
+    permute the codes themselves so they are binned exactly like the MI they are compared
+    to (see _calc_it_lags_coded)
+    codes_x, codes_y: integer arrays of shape (nobs,) of bin codes
+    returns the critical threshold of MI'''
+    rng = np.random.default_rng(seed)
+    MIss = []
+    for start in range(0, numiter, chunk_size):
+        n = min(chunk_size, numiter - start)
+        I_x = _shuffle_index(codes_x.size, n, rng)
+        I_y = _shuffle_index(codes_y.size, n, rng)
+        MIss.append(_calcMI_counts(_joint_counts([codes_x[I_x], codes_y[I_y]], nbins)))
+    MIss = np.sort(np.concatenate(MIss))
+    return MIss[min(math.ceil((1-alpha)*numiter), numiter - 1)]
+
+def _lag_slices(length_M, shift):
+    '''slices into the source and sink that make up the lagged triplet of lag_data
+    length_M: number of observations
+    shift: the number of time steps you want to lag the sink by, must be a positive integer
+    returns three slices for [source_lagged, sink_unlagged, sink_lagged]'''
+    if shift == 0:
+        #this is for => H(Xt-t, Yt, Yt-1) with shift = 0
+        newlength_M = length_M - 1
+        return slice(0, newlength_M), slice(0, newlength_M), slice(1, length_M)
+    #this is for => H(Xt-T, Yt, Yt-T)
+    newlength_M = length_M - shift
+    return slice(0, newlength_M), slice(shift, length_M), slice(0, newlength_M)
 
 def lag_data(M, shift):
     '''lags data by shift for transfer entropy calculation
@@ -210,25 +514,15 @@ def lag_data(M, shift):
     length_M = M.shape[0]
     cols_M = M.shape[1]
     
-    if shift == 0:
-        #this is for => H(Xt-t, Yt, Yt-1) with shift = 0
-        newlength_M = length_M - 1
-        M_lagged = np.nan*np.ones([newlength_M, cols_M+1])
-        M_lagged[:,0] = M[:(newlength_M),0]
-        M_lagged[:,1] = M[:(newlength_M),1]
-        M_lagged[:,2] = M[1:(length_M),1]
-
-    else:
-        #this is for => H(Xt-T, Yt, Yt-T)
-        newlength_M = length_M - shift
-        M_lagged = np.nan*np.ones([newlength_M, cols_M+1])
-        M_lagged[:,0] = M[:(length_M-shift),0]
-        M_lagged[:,1] = M[shift:(length_M)+1,1]
-        M_lagged[:,2] = M[:(length_M-shift),1]
+    s_xl, s_yu, s_yl = _lag_slices(length_M, shift)
+    M_lagged = np.nan*np.ones([s_xl.stop, cols_M+1])
+    M_lagged[:,0] = M[s_xl,0]
+    M_lagged[:,1] = M[s_yu,1]
+    M_lagged[:,2] = M[s_yl,1]
         
     return M_lagged
 
-def calcTE(M, shift, nbins):
+def calcTE(M, shift, nbins, binning = 'equal', sparse = None):
     '''calculate the transfer entropy from source lagged by shift to sink
     M: a numpy array of shape (nobs, 2) where nobs is the number of observations
     this assumes that the data are arrange such that the first column is the source and
@@ -237,56 +531,77 @@ def calcTE(M, shift, nbins):
     both is the same, it doesn't have to be for TE, but for simplicity we keep it that way here, 
     could be changed in the future
     nbins: is the number of bins used for estimating the pdf 
-    the mutual information is normalized by the entropy of the sink'''
-    #lag data
-    M_lagged = lag_data(M,shift)
-    #remove any rows where there is an nan value
-    M_short =  M_lagged[~np.isnan(M_lagged).any(axis=1)]
-    
-    M1 = M_short[:,(0,2)]  # [source_lagged(0:n-shift), sink_lagged(0:n-shift)]  =>H(Xt-T,Yt-T)
-    M2 = M_short[:,(1,2)] # [sink_unlagged(shift:n), sink_lagged(0:n-shift)]    =>H(Yt,Yt-T)
-    M3 = M_short[:,1]      # [sink_unlagged(0:n-shift)] =>H(Yt) 
-    
-    #calc joint entropy of H(Xt-T,Yt-T)
-    _, _, p_xlyl = calc2Dpdf(M1, nbins)
-    T1 = calcEntropy(p_xlyl)
-    
-    #calc joint entropy of H(Yt) and H(Yt-T)
-    py, pyl, p_yulyl = calc2Dpdf(M2, nbins)
-    T2 = calcEntropy(p_yulyl)
-    
-    #calc entropy of H(Y)
-    T3 = calcEntropy(py)
+    the mutual information is normalized by the entropy of the sink
+    binning: 'equal' (equal width) bins of the lagged data, or 'quantile' (equiprobable)
+    bins of each column of M, see calc_bin_codes and _subset_codes
+    sparse: boolean should the joint counts be sparse (see _sparse_joint_counts), the
+    default (None) uses sparse counts when most of the nbins**3 cells would be empty'''
+    if binning == 'quantile':
+        coded_x = _code_series(M[:,0], nbins, binning)
+        coded_y = _code_series(M[:,1], nbins, binning)
+        codes = _lagged_codes(coded_x, coded_y, shift, nbins)[0]
+    else:
+        #lag data
+        M_lagged = lag_data(M,shift)
+        #remove any rows where there is an nan value
+        M_short =  M_lagged[~np.isnan(M_lagged).any(axis=1)]
+        codes = calc_bin_codes(M_short, nbins, binning)
+        codes = [codes[:,0], codes[:,1], codes[:,2]]
     
-    #calc 3d joint entropy 
-    p_xlyulyl = calc3Dpdfs(M_short, nbins)
-    T4 = calcEntropy(p_xlyulyl)
-
-    T = (T1+T2-T3-T4)/T3 # Knuth formulation of transfer entropy
+    #all of the entropies come from the 3d joint counts H(Xt-T,Yt,Yt-T) and its
+    #marginals (see _calcTE_counts)
+    if _use_sparse(sparse, nbins, 3, codes[0].size):
+        return _calcTE_sparse(*_sparse_joint_counts(codes, nbins), nbins)
+    T = _calcTE_counts(_joint_counts(codes, nbins))
     
     return T
 
-def calcTE_shuffled(M, shift, nbins):
-    '''shuffles the input dataset to destroy temporal relationships for signficance testing
+def calcTE_surrogates(M, shift, nbins, numiter = 500, seed = None, chunk_size = 100,
+                      binning = 'equal'):
+    '''calculate the transfer entropy of shuffled surrogates of M for significance testing.
+    Each column is shuffled separately (only between its non-nan positions), and all of the
+    permutations are built at once as an index matrix and binned and counted in one pass
     M: a numpy array of shape (nobs, 2) where nobs is the number of observations
     this assumes that the data are arranged such that the first column is the source and
     the second column is the sink.
+    shift: time lag that should be considered
     nbins: is the number of bins used for estimating the pdf 
-    the transfer entropy is normalized by the entropy of the sink
-    returns a single TE value for a numpy array the same size and shape as M, 
-    but with the order shuffled'''
-    
-    Mss = np.ones(np.shape(M))*np.nan # Initialize
-    
-    for n in range(np.shape(M)[1]): # Columns are shuffled separately
-        n_nans = np.argwhere(~np.isnan(M[:,n]))
-        R = np.random.rand(np.shape(n_nans)[0],1)
-        I = np.argsort(R,axis=0)
-        Mss[n_nans[:,0],n] = M[n_nans[I[:],0],n].reshape(np.shape(M[n_nans[I[:],0],n])[0],)
-    TE_shuff = calcTE(Mss, shift, nbins)
-    return TE_shuff
-
-def calcTE_crit(M, shift, nbins, alpha, ncores, numiter = 500):
+    numiter: number of surrogates, default = 500
+    seed: seed for the random number generator
+    chunk_size: number of surrogates that are held in memory at one time
+    binning: 'equal' (equal width) or 'quantile' (equiprobable) bins, see calcTE
+    returns an array of shape (numiter,) of TE values'''
+    rng = np.random.default_rng(seed)
+    valid_x = ~np.isnan(M[:,0])
+    valid_y = ~np.isnan(M[:,1])
+    s_xl, s_yu, s_yl = _lag_slices(M.shape[0], shift)
+    #shuffling only moves values between non-nan positions, so the rows of the
+    #lagged data with a nan value are the same for every surrogate
+    keep = valid_x[s_xl] & valid_y[s_yu] & valid_y[s_yl]
+    #rank of each kept position among the non-nan positions of each column
+    rank_x = np.cumsum(valid_x) - 1
+    rank_y = np.cumsum(valid_y) - 1
+    rank_xl = rank_x[s_xl][keep]
+    rank_yu = rank_y[s_yu][keep]
+    rank_yl = rank_y[s_yl][keep]
+    #the non-nan values of each column and their codes are the same for every surrogate
+    x = M[valid_x, 0]
+    y = M[valid_y, 1]
+    codes_x = _series_codes(x, nbins, binning)
+    codes_y = _series_codes(y, nbins, binning)
+    
+    TEss = []
+    for start in range(0, numiter, chunk_size):
+        n = min(chunk_size, numiter - start)
+        I_x = _shuffle_index(x.size, n, rng)
+        I_y = _shuffle_index(y.size, n, rng)
+        codes = [_subset_codes(x, codes_x, I_x[:, rank_xl], nbins, binning),
+                 _subset_codes(y, codes_y, I_y[:, rank_yu], nbins, binning),
+                 _subset_codes(y, codes_y, I_y[:, rank_yl], nbins, binning)]
+        TEss.append(_calcTE_counts(_joint_counts(codes, nbins)))
+    return np.concatenate(TEss)
+
+def calcTE_crit(M, shift, nbins, alpha, numiter = 500, seed = None, binning = 'equal'):
     '''calculate the critical threshold of transfer entropy
     M: a numpy array of shape (nobs, 2) where nobs is the number of observations
     this assumes that the data are arrange such that the first column is the source and
@@ -295,18 +610,285 @@ def calcTE_crit(M, shift, nbins, alpha, ncores, numiter = 500):
     nbins: is the number of bins used for estimating the pdf 
     the transfer entropy is normalized by the entropy of the sink
     alpha: significance threshold
-    ncores: number of cores
-    numiter: number of iterations, default = 500'''
-    return 0
-    
-    # assert ncores < os.cpu_count()
-    
-    # TEss = Parallel(n_jobs=ncores)(delayed(calcTE_shuffled)(M, shift, nbins) for ii in range(numiter))
-    # TEss = np.sort(TEss)
-    # TEcrit = TEss[math.ceil((1-alpha)*numiter)] 
-    # return(TEcrit)
+    numiter: number of iterations, default = 500
+    seed: seed for the random number generator
+    binning: 'equal' (equal width) or 'quantile' (equiprobable) bins, see calcTE'''
+    TEss = np.sort(calcTE_surrogates(M, shift, nbins, numiter = numiter, seed = seed,
+                                     binning = binning))
+    TEcrit = TEss[min(math.ceil((1-alpha)*numiter), numiter - 1)]
+    return TEcrit
 
-def calc_it_metrics(M, Mswap, n_lags, nbins, alpha, ncores, calc_swap = True):
+def calc_it_lags(M, n_lags, nbins, alpha = None, calc_MI = True, numiter = 500,
+                 binning = 'equal', sparse = None, seed = None):
+    '''calculate mutual information, transfer entropy and correlation for all time lags
+    from 0 to n_lags in one pass. The source and sink are binned once and each lag takes
+    its triplet H(Xt-T, Yt, Yt-T) as slices of the coded arrays (see lag_data), instead of
+    copying and re-binning the data for every lag. MI and TE at each lag come from the same
+    3d joint counts and match calcMI and calcTE
+    M: a numpy array of shape (nobs, 2) where nobs is the number of observations
+    this assumes that the data are arrange such that the first column is the source and
+    the second column is the sink.
+    n_lags: number of time lag that should be considered, will calculate from 0-n_lags
+    nbins: is the number of bins used for estimating the pdf 
+    alpha: significance threshold, if given the critical thresholds of MI and TE are
+    calculated from numiter shuffled surrogates (see calcMI_crit and calcTE_crit)
+    calc_MI: boolean should mutual information and correlation be calculated, if False
+    only TE is calculated
+    numiter: number of surrogates used for the critical thresholds, default = 500
+    binning: 'equal' (equal width) or 'quantile' (equiprobable) bins, see calcTE
+    sparse: boolean should the joint counts be sparse (see _sparse_joint_counts), the
+    default (None) uses sparse counts when most of the nbins**3 cells would be empty
+    seed: seed for the random number generator of the surrogates, the same seed gives
+    the same critical thresholds. Each lag gets its own child seed (see _spawn_seeds)
+    returns a dictionary of numpy arrays of length n_lags'''
+    #bin the non-nan values of the source and sink once
+    coded_x = _code_series(M[:,0], nbins, binning)
+    coded_y = _code_series(M[:,1], nbins, binning)
+    return _calc_it_lags_coded(coded_x, coded_y, n_lags, nbins, alpha = alpha,
+                               calc_MI = calc_MI, numiter = numiter, sparse = sparse,
+                               seed = seed)
+
+def _code_series(sr, nbins, binning = 'equal'):
+    '''bins the non-nan values of one series, so the codes can be reused for every lag and
+    every pair the series is part of (see _calc_it_lags_coded)
+    sr: numpy array of shape (nobs,), nan where there is no observation
+    nbins: is the number of bins used for estimating the pdf
+    binning: 'equal' (equal width) or 'quantile' (equiprobable) bins, see calc_bin_codes
+    returns a dictionary with the series, its non-nan 'values', their 'codes', 'valid' (the
+    non-nan positions), 'rank' (the position of each observation among the non-nan values)
+    and the 'binning' '''
+    valid = ~np.isnan(sr)
+    values = sr[valid]
+    return {'series': sr, 'values': values, 'codes': _series_codes(values, nbins, binning),
+            'valid': valid, 'rank': np.cumsum(valid) - 1, 'binning': binning}
+
+def _lagged_codes(coded_x, coded_y, shift, nbins):
+    '''bin codes of the lagged triplet H(Xt-T, Yt, Yt-T) without the rows that have a nan
+    value, from the coded source and sink (see _code_series and lag_data)
+    returns the list of the three code arrays and the positions of the lagged source and
+    unlagged sink among the non-nan values of each series'''
+    s_xl, s_yu, s_yl = _lag_slices(coded_x['series'].size, shift)
+    keep = coded_x['valid'][s_xl] & coded_y['valid'][s_yu] & coded_y['valid'][s_yl]
+    rank_xl = coded_x['rank'][s_xl][keep]
+    rank_yu = coded_y['rank'][s_yu][keep]
+    rank_yl = coded_y['rank'][s_yl][keep]
+    codes = [_subset_codes(coded_x['values'], coded_x['codes'], rank_xl, nbins, coded_x['binning']),
+             _subset_codes(coded_y['values'], coded_y['codes'], rank_yu, nbins, coded_y['binning']),
+             _subset_codes(coded_y['values'], coded_y['codes'], rank_yl, nbins, coded_y['binning'])]
+    return codes, rank_xl, rank_yu
+
+def _calc_it_lags_coded(coded_x, coded_y, n_lags, nbins, alpha = None, calc_MI = True,
+                        numiter = 500, sparse = None, seed = None):
+    '''calc_it_lags from the coded source and sink (see _code_series)'''
+    x, y = coded_x['values'], coded_y['values']
+    binning = coded_x['binning']
+    M = np.stack((coded_x['series'], coded_y['series']), axis = 1)
+    
+    it_lags = {'MI':[], 'MIcrit':[], 'TE':[], 'TEcrit':[], 'corr':[]}
+    lag_seeds = _spawn_seeds(seed, n_lags)
+    for i in range(0, n_lags):
+        codes, rank_xl, rank_yu = _lagged_codes(coded_x, coded_y, i, nbins)
+        if rank_xl.size == 0:
+            #no triplet without a nan value (e.g. a series that is all nan), so there is
+            #nothing to estimate the pdfs from
+            it_lags['TE'].append(np.nan)
+            if alpha is not None:
+                it_lags['TEcrit'].append(np.nan)
+            if calc_MI:
+                it_lags['MI'].append(np.nan)
+                it_lags['corr'].append(np.nan)
+                if alpha is not None:
+                    it_lags['MIcrit'].append(np.nan)
+            continue
+        if _use_sparse(sparse, nbins, 3, rank_xl.size):
+            cells, counts = _sparse_joint_counts(codes, nbins)
+            it_lags['TE'].append(_calcTE_sparse(cells, counts, nbins))
+            if calc_MI:
+                #MI is between the lagged source and the unlagged sink
+                it_lags['MI'].append(_calcMI_sparse(*_sparse_marginal(cells, counts, nbins, 3, (0, 1)),
+                                                    nbins))
+        else:
+            counts_xlyulyl = _joint_counts(codes, nbins)
+            it_lags['TE'].append(_calcTE_counts(counts_xlyulyl))
+            if calc_MI:
+                it_lags['MI'].append(_calcMI_counts(np.sum(counts_xlyulyl, axis = 2)))
+        if alpha is not None:
+            it_lags['TEcrit'].append(calcTE_crit(M, shift = i, nbins = nbins, alpha = alpha,
+                                                 numiter = numiter, seed = lag_seeds[i],
+                                                 binning = binning))
+        if calc_MI:
+            #same as pearsonr, without the overhead of its input checks
+            it_lags['corr'].append(np.corrcoef(x[rank_xl], y[rank_yu])[0,1])
+            if alpha is not None:
+                #shuffle the same codes MI was counted from, re-binning the lagged subset
+                #would give different (quantile) bins than the MI
+                it_lags['MIcrit'].append(_calcMI_crit_codes(codes[0], codes[1], nbins, alpha,
+                                                            numiter = numiter,
+                                                            seed = lag_seeds[i]))
+    
+    return {key:np.array(val) for key, val in it_lags.items()}
+
+def calc_it_network(X, Y, n_lags, nbins, source_names = None, sink_names = None,
+                    alpha = None, numiter = 500, binning = 'equal', sparse = None, seed = None):
+    '''calculate mutual information, transfer entropy and correlation for all time lags
+    from 0 to n_lags between every source and every sink, i.e., the process network of
+    Ruddell and Kumar (2009) restricted to source -> sink links. Each source and sink is
+    binned once and its codes are reused for every pair and lag (see calc_it_lags)
+    X: a numpy array of shape (nobs, nsources), one column per source
+    Y: a numpy array of shape (nobs, nsinks), one column per sink, on the same time steps as X
+    n_lags: number of time lag that should be considered, will calculate from 0-n_lags
+    nbins: is the number of bins used for estimating the pdf
+    source_names: names of the sources, default is their column numbers
+    sink_names: names of the sinks, default is their column numbers
+    alpha: significance threshold, if given the critical thresholds of MI and TE are
+    calculated as well (see calc_it_lags)
+    numiter: number of surrogates used for the critical thresholds, default = 500
+    binning: 'equal' (equal width) or 'quantile' (equiprobable) bins, see calcTE
+    sparse: boolean should the joint counts be sparse, see calc_it_lags
+    seed: seed for the random number generator of the surrogates, each source/sink pair
+    gets its own child seed (see _spawn_seeds)
+    returns a pandas DataFrame with one row per source, sink and lag'''
+    if source_names is None:
+        source_names = list(range(X.shape[1]))
+    if sink_names is None:
+        sink_names = list(range(Y.shape[1]))
+    coded_sources = [_code_series(X[:,i], nbins, binning) for i in range(X.shape[1])]
+    coded_sinks = [_code_series(Y[:,j], nbins, binning) for j in range(Y.shape[1])]
+    
+    pair_seeds = iter(_spawn_seeds(seed, len(coded_sources)*len(coded_sinks)))
+    network = []
+    for source, coded_x in zip(source_names, coded_sources):
+        for sink, coded_y in zip(sink_names, coded_sinks):
+            it_lags = _calc_it_lags_coded(coded_x, coded_y, n_lags, nbins, alpha = alpha,
+                                          numiter = numiter, sparse = sparse,
+                                          seed = next(pair_seeds))
+            df = pd.DataFrame({key: val for key, val in it_lags.items() if len(val)})
+            df.insert(0, 'lag', np.arange(n_lags))
+            df.insert(0, 'sink', sink)
+            df.insert(0, 'source', source)
+            network.append(df)
+    return pd.concat(network, ignore_index = True)
+
+def _window_marginal_codes(codes, keep, nbins):
+    '''flat cell index of every lagged triplet in each of the marginal histograms that the
+    TE and MI entropies are calculated from, -1 where the triplet has a nan value
+    codes: list of the three integer code arrays [source_lagged, sink_unlagged, sink_lagged]
+    keep: boolean array, False where the triplet has a nan value
+    returns a dictionary of integer arrays'''
+    c_xl, c_yu, c_yl = codes
+    cells = {'xlyulyl': (c_xl*nbins + c_yu)*nbins + c_yl,
+             'xlyl': c_xl*nbins + c_yl,
+             'yulyl': c_yu*nbins + c_yl,
+             'yu': c_yu,
+             'xl': c_xl,
+             'xlyu': c_xl*nbins + c_yu}
+    return {key: np.where(keep, val, -1) for key, val in cells.items()}
+
+def calc_it_windows(M, n_lags, nbins, window, step = 1, calc_MI = True, binning = 'equal'):
+    '''calculate transfer entropy (and mutual information) for all time lags from 0 to
+    n_lags in moving windows over the record. Each window holds the lagged triplets
+    H(Xt-T, Yt, Yt-T) that lie entirely inside it (the same triplets as lag_data on the
+    window), so at each lag the TE of a window is calcTE of the window's data, except that
+    every window uses the bins of the whole record. With fixed bins the joint counts, and the
+    sums of c*log2(c) that the entropies come from, are updated as the window moves: the
+    triplets that enter the window are added and the ones that leave it are removed, rather
+    than counting each window again
+    M: a numpy array of shape (nobs, 2) where nobs is the number of observations
+    this assumes that the data are arrange such that the first column is the source and
+    the second column is the sink. Rows are consecutive time steps, gaps should be nan
+    n_lags: number of time lag that should be considered, will calculate from 0-n_lags
+    nbins: is the number of bins used for estimating the pdf
+    window: number of time steps (rows of M) in each window
+    step: number of time steps the window moves each time
+    calc_MI: boolean should mutual information be calculated as well
+    binning: 'equal' (equal width) or 'quantile' (equiprobable) bins of the whole record
+    returns a dictionary with 'TE' (and 'MI') arrays of shape (nwindows, n_lags), 'n' the
+    number of triplets in each window at each lag and 'start' the first row of each window'''
+    length_M = M.shape[0]
+    starts = np.arange(0, length_M - window + 1, step)
+    valid_x = ~np.isnan(M[:,0])
+    valid_y = ~np.isnan(M[:,1])
+    #bin the non-nan values of the source and sink once, with the bins of the whole record
+    codes_x = np.zeros(length_M, dtype = np.intp)
+    codes_y = np.zeros(length_M, dtype = np.intp)
+    codes_x[valid_x] = _series_codes(M[valid_x, 0], nbins, binning)
+    codes_y[valid_y] = _series_codes(M[valid_y, 1], nbins, binning)
+    
+    marginals = {'xlyulyl': 3, 'xlyl': 2, 'yulyl': 2, 'yu': 1}
+    if calc_MI:
+        marginals.update({'xl': 1, 'xlyu': 2})
+    #cell index of triplet j at lag i, padded with -1 to length_M so that the lags can be
+    #updated together, with each lag's histogram offset in one flat array of counts
+    cells = {key: np.full((n_lags, length_M), -1, dtype = np.intp) for key in marginals}
+    #number of rows each triplet spans after its first row
+    span = np.zeros(n_lags, dtype = np.intp)
+    for i in range(n_lags):
+        s_xl, s_yu, s_yl = _lag_slices(length_M, i)
+        span[i] = max(i, 1)
+        keep = valid_x[s_xl] & valid_y[s_yu] & valid_y[s_yl]
+        lag_cells = _window_marginal_codes([codes_x[s_xl], codes_y[s_yu], codes_y[s_yl]],
+                                           keep, nbins)
+        for key, ndim in marginals.items():
+            c = lag_cells[key]
+            cells[key][i, :c.size] = np.where(c >= 0, c + i*nbins**ndim, -1)
+    
+    lag_index = np.arange(n_lags)[:, None]
+    def window_cells(key, first, stop):
+        #cells of the triplets first[lag] to stop[lag] (exclusive) of each lag
+        width = int(np.max(stop - first)) if len(first) else 0
+        j = first[:, None] + np.arange(width)
+        j_in = (j < stop[:, None]) & (j >= 0)
+        c = cells[key][lag_index, np.where(j_in, j, 0)]
+        return c[j_in & (c >= 0)]
+    
+    counts = {key: np.zeros(n_lags*nbins**ndim, dtype = np.int64) for key, ndim in marginals.items()}
+    sum_clog2c = {key: np.zeros(n_lags) for key in marginals}
+    N = np.zeros(n_lags, dtype = np.int64)
+    out = {key: np.empty((len(starts), n_lags)) for key in ['TE', 'MI', 'n']}
+    for w, start in enumerate(starts):
+        #triplets j with start <= j and j + span < start + window are in the window
+        stop = start + window - span
+        if w == 0:
+            entering = {key: window_cells(key, np.full(n_lags, start), stop) for key in marginals}
+            leaving = {key: np.empty(0, dtype = np.intp) for key in marginals}
+        else:
+            prev_start = starts[w - 1]
+            entering = {key: window_cells(key, np.maximum(prev_start + window - span, start),
+                                          stop) for key in marginals}
+            leaving = {key: window_cells(key, np.full(n_lags, prev_start),
+                                         np.minimum(start, prev_start + window - span))
+                       for key in marginals}
+        for key, ndim in marginals.items():
+            size = nbins**ndim
+            changed = np.concatenate((entering[key], leaving[key]))
+            if changed.size == 0:
+                continue
+            cell, inverse = np.unique(changed, return_inverse = True)
+            delta = np.bincount(inverse, minlength = cell.size) - \
+                    2*np.bincount(inverse[entering[key].size:], minlength = cell.size)
+            old = counts[key][cell]
+            new = old + delta
+            counts[key][cell] = new
+            sum_clog2c[key] += np.bincount(cell // size, weights = _clog2c(new) - _clog2c(old),
+                                           minlength = n_lags)
+            if key == 'yu':
+                N += np.bincount(cell // size, weights = delta, minlength = n_lags).astype(np.int64)
+        
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            log2_N = np.log2(N)
+            H = {key: log2_N - sum_clog2c[key]/N for key in marginals}
+            out['TE'][w] = (H['xlyl'] + H['yulyl'] - H['yu'] - H['xlyulyl'])/H['yu']
+            if calc_MI:
+                out['MI'][w] = (H['xl'] + H['yu'] - H['xlyu'])/H['yu']
+        out['n'][w] = N
+    
+    it_windows = {'TE': out['TE'], 'n': out['n'].astype(np.int64), 'start': starts}
+    if calc_MI:
+        it_windows['MI'] = out['MI']
+    return it_windows
+
+def calc_it_metrics(M, Mswap, n_lags, nbins, alpha, calc_swap = True, one_pass = True,
+                    binning = 'equal', seed = None, numiter = 500):
     '''wrapper function for calculating mutual information and transfer entropy 
     (for both x -> y and y -> x) across a range of time lags. It also calculates
     a significance threshold for mutual information and transfer entropy using the 
@@ -319,9 +901,29 @@ def calc_it_metrics(M, Mswap, n_lags, nbins, alpha, ncores, calc_swap = True):
     nbins: is the number of bins used for estimating the pdf 
     the transfer entropy is normalized by the entropy of the sink variable
     alpha: significance threshold
-    ncores: number of cores
     calc_swap: boolean should the reverse transfer entropy be calculated as well (Y -> X)?
+    one_pass: boolean should all of the lags be calculated from a single binning of the
+    data (see calc_it_lags)? If False each lag is lagged and binned separately
+    binning: 'equal' (equal width) or 'quantile' (equiprobable) bins, see calcTE. With
+    quantile bins the outliers don't have to be removed to keep the bins from being empty
+    seed: seed for the random number generator of the surrogates, the same seed gives
+    the same critical thresholds. Each direction and lag gets its own child seed (see
+    _spawn_seeds), the same ones with and without one_pass
+    numiter: number of surrogates used for the critical thresholds, default = 500
     '''
+    seed, seed_swap = _spawn_seeds(seed, 2)
+    if one_pass:
+        it_lags = calc_it_lags(M, n_lags, nbins, alpha = alpha, binning = binning, seed = seed,
+                               numiter = numiter)
+        it_metrics = {key:list(val) for key, val in it_lags.items()}
+        it_metrics['TEswap'] = []
+        it_metrics['TEcritswap'] = []
+        if calc_swap:
+            it_lags_swap = calc_it_lags(Mswap, n_lags, nbins, alpha = alpha, calc_MI = False,
+                                        binning = binning, seed = seed_swap, numiter = numiter)
+            it_metrics['TEswap'] = list(it_lags_swap['TE'])
+            it_metrics['TEcritswap'] = list(it_lags_swap['TEcrit'])
+        return it_metrics
     
     MI = []
     MIcrit = []
@@ -330,28 +932,34 @@ def calc_it_metrics(M, Mswap, n_lags, nbins, alpha, ncores, calc_swap = True):
     TEcrit = []
     TEswap = []
     TEcritswap = []
+    lag_seeds = _spawn_seeds(seed, n_lags)
+    lag_seeds_swap = _spawn_seeds(seed_swap, n_lags)
     for i in range(0,n_lags):
         #lag data
         M_lagged = lag_data(M,shift = i)
         #remove any rows where there is an nan value
         M_short =  M_lagged[~np.isnan(M_lagged).any(axis=1)]
-        MItemp = calcMI(M_short[:,(0,1)], nbins)
+        MItemp = calcMI(M_short[:,(0,1)], nbins, binning = binning)
         MI.append(MItemp)
-        MIcrittemp = calcMI_crit(M_short[:,(0,1)], nbins, ncores = ncores, alpha = alpha)
+        MIcrittemp = calcMI_crit(M_short[:,(0,1)], nbins, alpha = alpha, seed = lag_seeds[i],
+                                 binning = binning, numiter = numiter)
         MIcrit.append(MIcrittemp)
         
         corrtemp = pearsonr(M_short[:,0], M_short[:,1])[0]
         corr.append(corrtemp)
         
-        TEtemp = calcTE(M, shift = i, nbins = nbins)
+        TEtemp = calcTE(M, shift = i, nbins = nbins, binning = binning)
         TE.append(TEtemp)
-        TEcrittemp = calcTE_crit(M, shift = i, nbins = nbins, ncores = ncores, alpha = alpha)
+        TEcrittemp = calcTE_crit(M, shift = i, nbins = nbins, alpha = alpha, seed = lag_seeds[i],
+                                 binning = binning, numiter = numiter)
         TEcrit.append(TEcrittemp)
         
         if calc_swap:
-            TEtempswap = calcTE(Mswap, shift = i, nbins = nbins)
+            TEtempswap = calcTE(Mswap, shift = i, nbins = nbins, binning = binning)
             TEswap.append(TEtempswap)
-            TEcrittempswap = calcTE_crit(Mswap, shift = i, nbins = nbins, ncores = ncores, alpha = alpha)
+            TEcrittempswap = calcTE_crit(Mswap, shift = i, nbins = nbins, alpha = alpha,
+                                         seed = lag_seeds_swap[i], binning = binning,
+                                         numiter = numiter)
             TEcritswap.append(TEcrittempswap)
         
     it_metrics = {'MI':MI, 'MIcrit':MIcrit,
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Frozen reference versions of the information theory functions, as they were
+in it_functions.py before it was optimized (commit a0715d3). They are only
+used by benchmark_it_functions.py to (re)compute the baselines the current
+functions are checked against, and should not be changed.
+
+The only change from the original is that remove_seasonal_signal indexes its
+series by position with .iloc, which newer versions of pandas require.
+
+Originally written by ggorski, see it_functions.py for the credits.
+"""
+
+import math
+import numpy as np
+
+class pre_proc_func:
+    '''this class of functions preprocesses the data to remove unwanted signals
+    and prepare the data for information theory calculations'''
+    def __init__(self):
+        pass
+
+    def log10(self, sr):
+        l10 = np.log10(sr+1e-6)
+        return l10
+    
+    def standardize(self, sr):
+        standardized = (sr - np.nanmean(sr))/np.nanstd(sr, ddof = 1)
+        return standardized
+
+    def normalize(self, sr):
+        normalized = (sr-np.nanmin(sr))/(np.nanmax(sr)-np.nanmin(sr))
+        return normalized
+    
+    def anomaly(self, sr):
+        anomaly = sr - np.nanmean(sr)
+        return anomaly
+
+    def remove_seasonal_signal(self, sr):
+        #calculate doy for sr
+        sr_doy = sr.index.strftime('%j')
+        #convert sr_historical to df
+        sr_historical_df = sr.to_frame().copy()
+        #calculate doy
+        sr_historical_df['doy'] = list(sr.index.strftime('%j'))
+        #calculate the doy means
+        doy_means = sr_historical_df.groupby('doy').mean()
+        #convert the index (doy) to int64
+        doy_means.index = doy_means.index.astype('int64')
+        seasonal_removed = list()
+        for i in range(len(sr)):
+            if math.isnan(sr.iloc[i]):
+                seasonal_removed.append(np.nan)
+            else:
+                doy = int(sr_doy[i])
+                doy_mean = doy_means.loc[doy]
+                value = sr.iloc[i]-doy_mean.iloc[0]
+                seasonal_removed.append(value)
+        return seasonal_removed
+
+def calc2Dpdf(M,nbins):
+    '''calculates the 3 pdfs, one for x, one for y and a joint pdf for x and y 
+    M: a numpy array of shape (nobs, 2) where nobs is the number of observations
+    this assumes that the data are arrange such that the first column is the source (x) and
+    the second column is the sink (y).
+    nbins: is the number of bins used for estimating the pdf '''
+    
+    counts, binEdges = np.histogramdd(M,bins=nbins)
+    p_xy = counts/np.sum(counts)
+    
+    p_x = np.sum(p_xy,axis=1)
+    p_y = np.sum(p_xy,axis=0)
+    
+    return p_x, p_y, p_xy
+
+def calc3Dpdfs(M, nbins):
+    '''calculates the 7 pdfs, one each for x, y, and z, one each for their individual
+    joint distributions, and one for the 3d joint distributions. Right now it only returns
+    the 3d joint distribution for simplicity
+    M: a numpy array of shape (nobs, 3) where nobs is the number of observations.
+    nbins: is the number of bins used for estimating the pdf '''
+    # use numpy histogram as pdf
+    pdf,edges = np.histogramdd(M,bins=nbins)
+    p_xyz = pdf/np.sum(pdf)
+    
+    #p_xy = np.sum(p_xyz,axis=2)
+    #p_xz = np.sum(p_xyz,axis=1)
+    #p_yz = np.sum(p_xyz,axis=0)
+    
+    #p_x = np.sum(p_xy,axis=1)
+    #p_y = np.sum(p_xy,axis=0)
+    #p_z = np.sum(p_xz,axis=0)
+    
+    return p_xyz
+
+def calcEntropy(pdf):
+    '''calculate the entropy from the pdf
+    here n_0 is used to indicate that all values are non-zero'''
+    
+    pdf_n_0 = pdf[pdf>0]
+    log2_pdf_n_0 = np.log2(pdf_n_0)
+    H = (-sum(pdf_n_0*log2_pdf_n_0))
+    return H
+
+def calcMI(M, nbins):
+    '''calculate mutual information of two variables
+    M: a numpy array of shape (nobs, 2) where nobs is the number of observations
+    this assumes that the data are arrange such that the first column is the source and
+    the second column is the sink.
+    nbins: is the number of bins used for estimating the pdf 
+    the mutual information is normalized by the entropy of the sink'''
+    
+    
+    p_x, p_y, p_xy = calc2Dpdf(M, nbins = nbins)
+    
+    Hx = calcEntropy(p_x)
+    Hy = calcEntropy(p_y)
+    Hxy = calcEntropy(p_xy)
+    
+    MI = (Hx+Hy-Hxy)/Hy
+    
+    return MI
+
+def lag_data(M, shift):
+    '''lags data by shift for transfer entropy calculation
+    M: a numpy array of shape (nobs, 2) where nobs is the number of observations
+    this assumes that the data are arranged such that the first column is the source and
+    the second column is the sink.
+    shift: the number of time steps you want to lag the sink by, must be a positive integer
+    returns M_lagged of dimensions [length(M)-shift, 3]
+    M_lagged[,0] = [source_lagged(0:n-shift)]  
+    M_lagged[,1] =  [sink_unlagged(shift:n)] 
+    M_lagged[,2] = [sink_lagged(0:n-shift)]
+    => H(Xt-T, Yt, Yt-T)'''
+    
+    length_M = M.shape[0]
+    cols_M = M.shape[1]
+    
+    if shift == 0:
+        #this is for => H(Xt-t, Yt, Yt-1) with shift = 0
+        newlength_M = length_M - 1
+        M_lagged = np.nan*np.ones([newlength_M, cols_M+1])
+        M_lagged[:,0] = M[:(newlength_M),0]
+        M_lagged[:,1] = M[:(newlength_M),1]
+        M_lagged[:,2] = M[1:(length_M),1]
+
+    else:
+        #this is for => H(Xt-T, Yt, Yt-T)
+        newlength_M = length_M - shift
+        M_lagged = np.nan*np.ones([newlength_M, cols_M+1])
+        M_lagged[:,0] = M[:(length_M-shift),0]
+        M_lagged[:,1] = M[shift:(length_M)+1,1]
+        M_lagged[:,2] = M[:(length_M-shift),1]
+        
+    return M_lagged
+
+def calcTE(M, shift, nbins):
+    '''calculate the transfer entropy from source lagged by shift to sink
+    M: a numpy array of shape (nobs, 2) where nobs is the number of observations
+    this assumes that the data are arrange such that the first column is the source and
+    the second column is the sink.
+    shift: the amount of time steps to lag the source and sink, this assumes that the shift for
+    both is the same, it doesn't have to be for TE, but for simplicity we keep it that way here, 
+    could be changed in the future
+    nbins: is the number of bins used for estimating the pdf 
+    the mutual information is normalized by the entropy of the sink'''
+    #lag data
+    M_lagged = lag_data(M,shift)
+    #remove any rows where there is an nan value
+    M_short =  M_lagged[~np.isnan(M_lagged).any(axis=1)]
+    
+    M1 = M_short[:,(0,2)]  # [source_lagged(0:n-shift), sink_lagged(0:n-shift)]  =>H(Xt-T,Yt-T)
+    M2 = M_short[:,(1,2)] # [sink_unlagged(shift:n), sink_lagged(0:n-shift)]    =>H(Yt,Yt-T)
+    M3 = M_short[:,1]      # [sink_unlagged(0:n-shift)] =>H(Yt) 
+    
+    #calc joint entropy of H(Xt-T,Yt-T)
+    _, _, p_xlyl = calc2Dpdf(M1, nbins)
+    T1 = calcEntropy(p_xlyl)
+    
+    #calc joint entropy of H(Yt) and H(Yt-T)
+    py, pyl, p_yulyl = calc2Dpdf(M2, nbins)
+    T2 = calcEntropy(p_yulyl)
+    
+    #calc entropy of H(Y)
+    T3 = calcEntropy(py)
+    
+    #calc 3d joint entropy 
+    p_xlyulyl = calc3Dpdfs(M_short, nbins)
+    T4 = calcEntropy(p_xlyulyl)
+
+    T = (T1+T2-T3-T4)/T3 # Knuth formulation of transfer entropy
+    
+    return T
@@ -2,12 +2,13 @@ code_dir = '../river-dl'
 import sys
 sys.path.insert(0, code_dir)
 # if using river_dl installed with pip this is not needed
+sys.path.insert(0, "..")
 
-from model import LSTMModelStates
 from river_dl.postproc_utils import prepped_array_to_df
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
+from utils import write_prepped_arrays, load_prepped
 
 
 in_dir = "../../../out/models/0_baseline_LSTM"
@@ -33,13 +34,24 @@ rule all:
                ),
 
 
+rule write_prepped_arrays:
+    input:
+        "{path}/prepped.npz",
+    output:
+        directory("{path}/prepped"),
+    run:
+        write_prepped_arrays(input[0], output[0])
+
+
 rule write_states:
     input:
-        f"{in_dir}/nstates_{{nstates}}/rep_{{rep}}/prepped.npz",
+        f"{in_dir}/nstates_{{nstates}}/rep_{{rep}}/prepped",
         f"{in_dir}/nstates_{{nstates}}/rep_{{rep}}/train_weights/",
     output:
-        "{outdir}/nstates_{nstates}/analyze_states/rep_{rep}/states_{trained_or_random}.csv"
+        "{outdir}/nstates_{nstates}/analyze_states/rep_{rep}/states_{trained_or_random}.parquet"
     run:
+        from model import LSTMModelStates
+
         model = LSTMModelStates(
             int(wildcards.nstates),
             recurrent_dropout=config['recurrent_dropout'],
@@ -48,43 +60,54 @@ rule write_states:
         )
 
 
-        data = np.load(input[0], allow_pickle=True)
+        data = load_prepped(input[0])
         if wildcards.trained_or_random == "trained":
             model.load_weights(input[1] + "/")
-        states = model(data['x_val']).numpy()
+        states = model(data['x_val']).numpy().astype(np.float32)
+        state_cols = [f"h{i}" for i in range(int(wildcards.nstates))]
         states_df = prepped_array_to_df(states, data["times_val"], data["ids_val"],
-                                        col_names=[f"h{i}" for i in range(int(wildcards.nstates))], 
+                                        col_names=state_cols,
                                         spatial_idx_name="site_id")
         states_df["site_id"] = states_df["site_id"].astype(str)
-        states_df.to_csv(output[0], index=False)
+        states_df["date"] = pd.to_datetime(states_df["date"])
+        states_df[state_cols] = states_df[state_cols].astype(np.float32)
+        states_df.to_parquet(output[0], index=False)
 
 
+# all of the sites are plotted from one read of the states
 rule plot_states:
     input:
-        "{outdir}/nstates_{nstates}/analyze_states/rep_{rep}/states_{trained_or_random}.csv"
+        "{outdir}/nstates_{nstates}/analyze_states/rep_{rep}/states_{trained_or_random}.parquet"
     output:
-        "{outdir}/nstates_{nstates}/analyze_states/rep_{rep}/states_{trained_or_random}_{site_id}.png"
+        expand("{{outdir}}/nstates_{{nstates}}/analyze_states/rep_{{rep}}/states_{{trained_or_random}}_{site_id}.png",
+               site_id=get_site_ids())
     run:
-        df = pd.read_csv(input[0], parse_dates=["date"], infer_datetime_format=True, dtype={"site_id": str})
-        df_site = df.query(f"site_id == '{wildcards.site_id}'")
-        del df_site["site_id"]
-        df_site = df_site.set_index("date")
-        axs = df_site.plot(subplots=True, figsize=(8,10))
-        for ax in axs.flatten():
-            ax.legend(loc = "upper left")
-        plt.suptitle(wildcards.site_id)
-        plt.tight_layout()
-        plt.savefig(output[0])
+        df = pd.read_parquet(input[0])
+        df_sites = dict(tuple(df.groupby("site_id")))
+        missing = [site_id for site_id in get_site_ids() if site_id not in df_sites]
+        if missing:
+            raise ValueError(f"no states in {input[0]} for sites {missing}")
+        for site_id, out_file in zip(get_site_ids(), output):
+            df_site = df_sites[site_id].drop(columns="site_id").set_index("date")
+            axs = df_site.plot(subplots=True, figsize=(8,10))
+            for ax in axs.flatten():
+                ax.legend(loc = "upper left")
+            plt.suptitle(site_id)
+            plt.tight_layout()
+            plt.savefig(out_file)
+            plt.close("all")
     
 
 rule plot_output_weights:
     input:
-        f"{in_dir}/nstates_{{nstates}}/rep_{{rep}}/prepped.npz",
+        f"{in_dir}/nstates_{{nstates}}/rep_{{rep}}/prepped",
         f"{in_dir}/nstates_{{nstates}}/rep_{{rep}}/train_weights/",
     output:
         "{outdir}/nstates_{nstates}/analyze_states/rep_{rep}/output_weights.jpg"
     run:
-        data = np.load(input[0], allow_pickle=True)
+        from model import LSTMModelStates
+
+        data = load_prepped(input[0])
         m = LSTMModelStates(
             int(wildcards.nstates),
             recurrent_dropout=config['recurrent_dropout'],
@@ -26,8 +26,14 @@ class LSTMModel(tf.keras.Model):
     @tf.function
     def call(self, inputs):
         h = self.rnn_layer(inputs)
-        prediction = self.dense(h)
-        return prediction
+        return self.output_head(h)
+
+    def output_head(self, h):
+        """
+        :param h: [tensor] hidden states from the LSTM
+        :return: [tensor] the predictions
+        """
+        return self.dense(h)
 
 
 class LSTMModelStates(tf.keras.Model):
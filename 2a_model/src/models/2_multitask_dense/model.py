@@ -26,9 +26,17 @@ class LSTMModel2Dense(tf.keras.Model):
     @tf.function
     def call(self, inputs):
         h = self.rnn_layer(inputs)
+        return self.output_head(h)
+
+    def output_head(self, h):
+        """
+        :param h: [tensor] hidden states from the LSTM
+        :return: [tensor] the DO predictions followed by the metabolism
+        predictions
+        """
         metab_prediction = self.metab_dense(h)
         do_prediction = self.do_dense(metab_prediction)
-        return tf.concat((do_prediction, metab_prediction), axis=2)
+        return tf.concat((do_prediction, metab_prediction), axis=-1)
 
 
 class LSTMModelStates(tf.keras.Model):
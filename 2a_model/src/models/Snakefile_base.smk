@@ -1,10 +1,10 @@
 import os
 import xarray as xr
-import tensorflow as tf
 import numpy as np
 import pandas as pd
 import sys
-from utils import get_train_val, get_holdouts
+from utils import get_train_val, get_holdouts, load_prepped
+from preds_store import get_store_file, write_preds_to_store
 
 river_dl_dir = "../river-dl"
 sys.path.append(river_dl_dir)
@@ -16,13 +16,17 @@ from river_dl.preproc_utils import asRunConfig
 from river_dl.preproc_utils import prep_all_data
 from river_dl.evaluate import combined_metrics
 from river_dl.postproc_utils import plot_obs, plot_ts, prepped_array_to_df
-from river_dl.predict import predict_from_arbitrary_data
-from river_dl.train import train_model
-from river_dl import loss_functions as lf
-from do_it_functions import calc_it_metrics_site
+from do_it_functions import calc_it_metrics_site, calc_it_metrics_replicate, calc_it_windows_site, calc_it_network_site
 
 out_dir = os.path.join(config['out_dir'], config['exp_name'])
-loss_function = lf.multitask_rmse(config['lambdas'])
+# predictions of all of the models, holdouts and reps in one parquet dataset
+preds_store_dir = os.path.join(config['out_dir'], "preds_store")
+
+# tensorflow and the model classes are only imported in the rules that use
+# them (train and make_predictions) so that the other rules, and building the
+# DAG, don't pay for the tensorflow import. The model Snakefiles pass the
+# model as plain data, params.model_spec, which the rules build with
+# training.build_model
 
 include: "visualize_models.smk"
 
@@ -36,29 +40,72 @@ rule as_run_config:
 # Finetune/train the model on observations
 rule train:
     input:
-        "{outdir}/holdout_{holdout}/prepped.npz"
+        "{outdir}/holdout_{holdout}/prepped"
     output:
         directory("{outdir}/holdout_{holdout}/rep_{rep}/train_weights/"),
         "{outdir}/holdout_{holdout}/rep_{rep}/train_log.csv",
         "{outdir}/holdout_{holdout}/rep_{rep}/train_time.txt",
+        "{outdir}/holdout_{holdout}/rep_{rep}/train_perf.csv",
+        "{outdir}/holdout_{holdout}/rep_{rep}/train_perf_summary.csv",
+    run:
+        from training import build_model, compile_and_train
+
+        model = build_model(params.model_spec)
+        profile_dir = None
+        if config.get('train_profile', False):
+            profile_dir = os.path.join(os.path.dirname(output[1]), "train_profile")
+        # I need to add a trailing slash here. Otherwise the wgts
+        # get saved in the "outdir"
+        compile_and_train(model, input[0], output[0] + "/", output[1], output[2], config,
+                          perf_file=output[3],
+                          perf_summary_file=output[4],
+                          profile_dir=profile_dir)
+
+
+# Train all of the holdouts and replicates in one job with a pool of
+# long-lived workers (tensorflow is imported once per worker, not once per
+# run). Declares and writes the same files as the train rule for every
+# holdout and rep; train has priority (see ruleorder below), so run this as a
+# target, e.g., `snakemake base_train_all`, before the rest of the workflow
+# and the trained runs are then up to date for it. Uses train_all_workers
+# workers with train_threads_per_worker threads each
+TRAIN_RUNS = expand("{outdir}/holdout_{holdout}/rep_{rep}",
+                    outdir=out_dir,
+                    holdout=get_holdouts(config),
+                    rep=list(range(config['num_replicates'])))
+
+rule train_all:
+    input:
+        expand("{outdir}/holdout_{holdout}/prepped",
+               outdir=out_dir,
+               holdout=get_holdouts(config)),
+    output:
+        weights=[directory(f"{run_dir}/train_weights/") for run_dir in TRAIN_RUNS],
+        logs=[f"{run_dir}/train_log.csv" for run_dir in TRAIN_RUNS],
+        times=[f"{run_dir}/train_time.txt" for run_dir in TRAIN_RUNS],
+        perf=[f"{run_dir}/train_perf.csv" for run_dir in TRAIN_RUNS],
+        perf_summary=[f"{run_dir}/train_perf_summary.csv" for run_dir in TRAIN_RUNS],
+    threads: config.get('train_all_workers', 4)*config.get('train_threads_per_worker', 1)
     run:
-        optimizer = tf.optimizers.Adam(learning_rate=config['finetune_learning_rate']) 
-        params.model.compile(optimizer=optimizer, loss=loss_function)
-        data = np.load(input[0], allow_pickle=True)
-        nsegs = len(np.unique(data["ids_trn"]))
-        train_model(params.model,
-                    x_trn = data['x_trn'],
-                    y_trn = data['y_obs_trn'],
-                    epochs = config['epochs'],
-                    batch_size = nsegs,
-                    #x_val = data['x_val'],
-                    #y_val = data['y_obs_val'],
-                    # I need to add a trailing slash here. Otherwise the wgts
-                    # get saved in the "outdir"
-                    weight_dir = output[0] + "/",
-                    log_file = output[1],
-                    time_file = output[2],
-                    early_stop_patience=config['early_stopping'])
+        from training import train_many
+
+        jobs = []
+        for i, run_dir in enumerate(TRAIN_RUNS):
+            jobs.append(dict(prepped=os.path.join(os.path.dirname(run_dir), "prepped"),
+                             weight_dir=output.weights[i] + "/",
+                             log_file=output.logs[i],
+                             time_file=output.times[i],
+                             perf_file=output.perf[i],
+                             perf_summary_file=output.perf_summary[i],
+                             profile_dir=(f"{run_dir}/train_profile"
+                                          if config.get('train_profile', False) else None)))
+        threads_per_worker = config.get('train_threads_per_worker', 1)
+        train_many(jobs, params.model_spec, dict(config),
+                   n_workers=max(1, threads // threads_per_worker),
+                   threads_per_worker=threads_per_worker)
+
+
+ruleorder: train > train_all
 
 
 rule make_predictions:
@@ -69,66 +116,147 @@ rule make_predictions:
     output:
         "{outdir}/holdout_{holdout}/rep_{rep}/preds.feather",
     run:
+        from river_dl.predict import predict_from_arbitrary_data
+        from training import build_model
+
         trn_end, val_start, val_end, val_sites = get_train_val(wildcards.holdout, config)
         weight_dir = input[1] + "/"
-        params.model.load_weights(weight_dir)
+        model = build_model(params.model_spec)
+        model.load_weights(weight_dir)
         preds = predict_from_arbitrary_data(raw_data_file=input[2],
                                             pred_start_date = config['train_start_date'],
                                             pred_end_date = config['val_end_date_temporal_holdout'],
                                             train_io_data=input[0],
-                                            model=params.model, 
+                                            model=model, 
                                             spatial_idx_name='site_id',
                                             time_idx_name='date')
         preds.reset_index(drop=True).to_feather(output[0])
 
 
-def filter_predictions(all_preds_file, partition, holdout, config, out_file):
-        trn_end, val_start, val_end, val_sites = get_train_val(holdout, config)
+# predictions from StreamingLSTM. By default (stream_reset_every: ~) the LSTM
+# states are carried over the whole record; with 365 they are the same as
+# make_predictions
+rule make_streaming_predictions:
+    input:
+        "{outdir}/holdout_{holdout}/prepped.npz",
+        "{outdir}/holdout_{holdout}/rep_{rep}/train_weights/",
+        "../../../out/well_obs_io.zarr",
+    output:
+        "{outdir}/holdout_{holdout}/rep_{rep}/preds_streaming.feather",
+    run:
+        from inference import predict_streaming
+        from training import build_model
+
+        model = build_model(params.model_spec)
+        model.load_weights(input[1] + "/")
+        preds = predict_streaming(model,
+                                  train_io_data=input[0],
+                                  raw_data_file=input[2],
+                                  pred_start_date=config['train_start_date'],
+                                  pred_end_date=config['val_end_date_temporal_holdout'],
+                                  chunk_len=config.get('streaming_chunk_len', 365),
+                                  reset_every=config.get('stream_reset_every'),
+                                  spatial_idx_name='site_id',
+                                  time_idx_name='date')
+        preds.to_feather(output[0])
+
+
+rule make_ensemble_predictions:
+    input:
+        prepped="{outdir}/holdout_{holdout}/prepped.npz",
+        weights=expand("{{outdir}}/holdout_{{holdout}}/rep_{rep}/train_weights/",
+                       rep=list(range(config['num_replicates']))),
+        io_data="../../../out/well_obs_io.zarr",
+    output:
+        "{outdir}/holdout_{holdout}/ensemble_preds.feather",
+        "{outdir}/holdout_{holdout}/ensemble_stats.feather",
+    run:
+        from inference import predict_ensemble
+
+        reps = list(range(config['num_replicates']))
+        rep_preds, ensemble_stats = predict_ensemble(params.model_spec,
+                                                     dict(zip(reps, input.weights)),
+                                                     train_io_data=input.prepped,
+                                                     raw_data_file=input.io_data,
+                                                     pred_start_date=config['train_start_date'],
+                                                     pred_end_date=config['val_end_date_temporal_holdout'],
+                                                     spatial_idx_name='site_id',
+                                                     time_idx_name='date')
+        rep_preds.to_feather(output[0])
+        ensemble_stats.to_feather(output[1])
+
+
+rule add_preds_to_store:
+    input:
+        f"{out_dir}/holdout_{{holdout}}/rep_{{rep}}/preds.feather",
+    output:
+        get_store_file(preds_store_dir, config['exp_name'], "{holdout}", "{rep}")
+    run:
+        write_preds_to_store(input[0], preds_store_dir, config['exp_name'],
+                             wildcards.holdout, int(wildcards.rep))
 
-        df_preds = pd.read_feather(all_preds_file)
-        all_sites = df_preds.site_id.unique()
-        trn_sites = all_sites[~np.isin(all_sites, val_sites)]
 
-        df_preds_trn_sites = df_preds[df_preds.site_id.isin(trn_sites)] 
+# all of the predictions of the experiment in the preds store, for reading
+# many models/holdouts/reps at once with preds_store.read_preds_from_store.
+# The workflow itself reads preds.feather, so the store isn't part of the
+# default target, run it on request, e.g., `snakemake base_gather_preds_store`
+rule gather_preds_store:
+    input:
+        expand(get_store_file(preds_store_dir, config['exp_name'], "{holdout}", "{rep}"),
+               holdout=get_holdouts(config),
+               rep=list(range(config['num_replicates'])))
 
-        df_preds_val_sites = df_preds[df_preds.site_id.isin(val_sites)] 
 
+PARTITIONS = ["trn", "val", "val_times"]
 
-        if partition == "trn":
-            df_preds_filt = df_preds_trn_sites[(df_preds_trn_sites.date >= config['train_start_date']) &
-                                               (df_preds_trn_sites.date < trn_end)]
-        elif partition == "val":
-            # get all of the data in the validation sites and in the validation period
-            # this assumes that the test period follows the validation period which follows the train period
-            df_preds_filt_val = df_preds_val_sites
-            if val_end and val_start:
-                df_preds_filt_trn = df_preds_trn_sites[(df_preds_trn_sites.date < val_end) &
-                                                       (df_preds_trn_sites.date >= val_start)]
-                df_preds_filt = pd.concat([df_preds_filt_val , df_preds_filt_trn], axis=0)
-            else:
-                df_preds_filt = df_preds_filt_val
 
-        elif partition == "val_times":
-            # get the data in just the validation times at train and val sites
-            df_preds_filt_val = df_preds_val_sites[(df_preds_val_sites.date < val_end) &
-                                                   (df_preds_val_sites.date >= val_start)]
-            df_preds_filt_trn = df_preds_trn_sites[(df_preds_trn_sites.date < val_end) &
-                                                   (df_preds_trn_sites.date >= val_start)]
-            df_preds_filt = pd.concat([df_preds_filt_val , df_preds_filt_trn], axis=0)
+def partition_predictions(all_preds_file, holdout, config, out_file):
+    """
+    label every row of the predictions with the partitions it belongs to in a
+    boolean column per partition ("trn", "val" and "val_times"), so the
+    predictions are read and filtered once for all of the partitions
+    """
+    trn_end, val_start, val_end, val_sites = get_train_val(holdout, config)
 
+    df_preds = pd.read_feather(all_preds_file)
+    dates = pd.to_datetime(df_preds['date']).values
+    in_val_sites = df_preds['site_id'].isin(val_sites).values
 
-        df_preds_filt.reset_index(drop=True).to_feather(out_file)
+    in_trn_times = ((dates >= np.datetime64(config['train_start_date'])) &
+                    (dates < np.datetime64(trn_end)))
+    if val_end and val_start:
+        in_val_times = ((dates >= np.datetime64(val_start)) &
+                        (dates < np.datetime64(val_end)))
+    else:
+        in_val_times = np.zeros(len(df_preds), dtype=bool)
 
+    # train sites in the training period
+    df_preds['trn'] = ~in_val_sites & in_trn_times
+    # all of the data in the validation sites and the data in the validation
+    # period at the train sites. this assumes that the test period follows the
+    # validation period which follows the train period
+    df_preds['val'] = in_val_sites | in_val_times
+    # the data in just the validation times at train and val sites
+    df_preds['val_times'] = in_val_times
 
+    df_preds.to_parquet(out_file, index=False)
 
 
-rule make_filtered_predictions:
+def get_partition(df_partitioned, partition):
+    """
+    select the predictions of one partition from the output of partition_predictions
+    """
+    df_preds = df_partitioned.loc[df_partitioned[partition]]
+    return df_preds.drop(columns=PARTITIONS).reset_index(drop=True)
+
+
+rule make_partitioned_predictions:
     input:
         "{outdir}/holdout_{holdout}/rep_{rep}/preds.feather",
     output:
-        "{outdir}/holdout_{holdout}/rep_{rep}/{partition}_preds.feather"
+        "{outdir}/holdout_{holdout}/rep_{rep}/partitioned_preds.parquet"
     run:
-        filter_predictions(input[0], wildcards.partition, wildcards.holdout, config, output[0])
+        partition_predictions(input[0], wildcards.holdout, config, output[0])
 
  
 def get_grp_arg(wildcards):
@@ -145,16 +273,16 @@ def get_grp_arg(wildcards):
 rule combine_metrics:
      input:
           "../../../out/well_obs_io.zarr",
-          "{outdir}/holdout_{holdout}/rep_{rep}/trn_preds.feather",
-          "{outdir}/holdout_{holdout}/rep_{rep}/val_preds.feather",
+          "{outdir}/holdout_{holdout}/rep_{rep}/partitioned_preds.parquet",
      output:
           "{outdir}/holdout_{holdout}/rep_{rep}/{metric_type}_metrics.csv"
      params:
          grp_arg = get_grp_arg
      run:
+         df_partitioned = pd.read_parquet(input[1])
          combined_metrics(obs_file=input[0],
-                          pred_data = {"train": input[1],
-                                       "val": input[2]},
+                          pred_data = {"train": get_partition(df_partitioned, "trn"),
+                                       "val": get_partition(df_partitioned, "val")},
                           spatial_idx_name='site_id',
                           time_idx_name='date',
                           group=params.grp_arg,
@@ -177,6 +305,30 @@ rule exp_metrics:
         all_df.to_csv(output[0], index=False)
         
  
+# training performance (time, steps/s, memory, tracing) of every holdout and
+# replicate, to compare model versions
+rule exp_train_perf:
+     input:
+        expand("{outdir}/holdout_{holdout}/rep_{rep}/train_perf_summary.csv",
+                outdir=out_dir,
+                holdout=get_holdouts(config),
+                rep=list(range(config['num_replicates'])),
+        )
+     output:
+          "{outdir}/exp_train_perf.csv"
+     run:
+        perf_dfs = []
+        for perf_file in input:
+            # .../holdout_{holdout}/rep_{rep}/train_perf_summary.csv
+            run_dir = os.path.dirname(perf_file)
+            df = pd.read_csv(perf_file)
+            df.insert(0, "rep", int(os.path.basename(run_dir).split("_", 1)[1]))
+            df.insert(0, "holdout", os.path.basename(os.path.dirname(run_dir)).split("_", 1)[1])
+            df.insert(0, "model", config['exp_name'])
+            perf_dfs.append(df)
+        pd.concat(perf_dfs).to_csv(output[0], index=False)
+
+
 rule calc_functional_performance_one:
     input:
         "../../../out/well_obs_io.zarr",
@@ -192,12 +344,53 @@ rule calc_functional_performance_one:
                                       log_transform=False,
                                       model=wildcards.model,
                                       replicate=wildcards.rep,
-                                      outfile=output[0])
+                                      outfile=output[0],
+                                      binning=config.get('it_binning', 'equal'),
+                                      seed=config.get('it_seed', 0))
 
 
 wildcard_constraints:
     site="\d+"
-                                      
+
+
+# time resolved TE/MI of one source and sink in moving windows over the record
+rule calc_it_windows_one:
+    input:
+        "../../../out/well_obs_io.zarr",
+        "{outdir}/holdout_{holdout}/rep_{rep}/preds.feather"
+    output:
+        "{outdir}/holdout_{holdout}/rep_{rep}/it_windows/{site}-{src}-{snk}-{model}.nc"
+    run:
+        calc_it_windows_site(input[0],
+                             input[1],
+                             wildcards.src,
+                             wildcards.snk,
+                             wildcards.site,
+                             log_transform=False,
+                             model=wildcards.model,
+                             window=config.get('it_window', 365),
+                             step=config.get('it_window_step', 30),
+                             outfile=output[0],
+                             binning=config.get('it_binning', 'equal'))
+
+
+# MI/TE/corr lag curves of every input (source) against every DO variable
+# (sink) at one site, with each series binned once for all of its pairs
+rule calc_it_network_one:
+    input:
+        "../../../out/well_obs_io.zarr",
+        "{outdir}/holdout_{holdout}/rep_{rep}/preds.feather"
+    output:
+        "{outdir}/holdout_{holdout}/rep_{rep}/it_network/{site}-{model}.parquet"
+    run:
+        calc_it_network_site(input[0],
+                             input[1],
+                             wildcards.site,
+                             model=wildcards.model,
+                             outfile=output[0],
+                             binning=config.get('it_binning', 'equal'),
+                             seed=config.get('it_seed', 0))
+
 
 rule add_holdout_to_func_performance:
     input:
@@ -212,29 +405,45 @@ rule add_holdout_to_func_performance:
 
 def get_func_perf_sites():
     input_file = "../../../out/well_obs_io.zarr"
+    # only the site_id coordinate is read, the data variables are never loaded,
+    # so parsing the workflow doesn't depend on the size of the dataset
     inputs = xr.open_zarr(input_file, consolidated=False)
-    inputs_df = inputs.to_dataframe()
-    
-    sites = inputs_df.index.unique('site_id')
+    sites = inputs.indexes['site_id']
     sites = sites.drop(['014721254', '014721259'])
     return sites
 
 
+rule calc_functional_performance_rep:
+    input:
+        "../../../out/well_obs_io.zarr",
+        "{outdir}/holdout_{holdout}/rep_{rep}/preds.feather"
+    output:
+        "{outdir}/holdout_{holdout}/rep_{rep}/func_perf_{model}.parquet"
+    threads: workflow.cores
+    run:
+        calc_it_metrics_replicate(input[0],
+                                  input[1],
+                                  sites=get_func_perf_sites(),
+                                  sources=['tmmx'],
+                                  sinks=['do_min', 'do_mean', 'do_max'],
+                                  log_transform=False,
+                                  model=wildcards.model,
+                                  replicate=wildcards.rep,
+                                  holdout=wildcards.holdout,
+                                  outfile=output[0],
+                                  n_workers=threads,
+                                  binning=config.get('it_binning', 'equal'),
+                                  seed=config.get('it_seed', 0))
+
+
 rule gather_func_performances:
     input:
-        expand("{outdir}/holdout_{holdout}/rep_{rep}/func_perf/with_ho_{site}-{src}-{snk}-{{model}}.csv",
+        expand("{outdir}/holdout_{holdout}/rep_{rep}/func_perf_{{model}}.parquet",
                 outdir=out_dir,
                 rep=list(range(config['num_replicates'])),
-                site=get_func_perf_sites(),
-                holdout=get_holdouts(config),
-                src=['tmmx'],
-                snk=['do_min', 'do_mean', 'do_max'])
+                holdout=get_holdouts(config))
     output:
         "{outdir}/{model}_func_perf.csv"
     run:
-        df_list = []
-        for in_file in input:
-            df = pd.read_csv(in_file, dtype={"site": str})
-            df_list.append(df)
-        df_comb = pd.concat(df_list)
+        df_comb = pd.concat([pd.read_parquet(in_file) for in_file in input])
         df_comb.to_csv(output[0], index=False)
@@ -3,7 +3,7 @@ configfile: "../config_base.yml"
 
 import sys
 import numpy as np
-from utils import get_train_val, get_holdouts
+from utils import get_train_val, get_holdouts, write_prepped_arrays, load_prepped
 
 river_dl_dir = "../river-dl"
 sys.path.append(river_dl_dir)
@@ -28,7 +28,9 @@ rule prep_io_data:
     input:
         "../../../out/well_obs_io.zarr",
     output:
-        "{outdir}/holdout_{holdout}/prepped.npz"
+        "{outdir}/holdout_{holdout}/prepped.npz",
+        # the same arrays as .npy files (+ manifest.json) for memory-mapping
+        directory("{outdir}/holdout_{holdout}/prepped"),
     run:
         trn_end, val_start, val_end, val_sites = get_train_val(wildcards.holdout, config) 
         prep_all_data(x_data_file=input[0],
@@ -50,7 +52,8 @@ rule prep_io_data:
 
         # check to make sure there is no validation data
         # in the training data set
-        data = np.load(output[0], allow_pickle=True)
+        write_prepped_arrays(output[0], output[1])
+        data = load_prepped(output[1])
         df_trn = prepped_array_to_df(data['y_obs_trn'],
                                      data['times_trn'],
                                      data['ids_trn'],
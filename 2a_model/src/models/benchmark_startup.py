@@ -0,0 +1,58 @@
+"""
+Startup benchmark for the model workflows
+
+Times the tensorflow import on its own, a snakemake dry run (DAG construction)
+and a forced rerun of the rules that don't train or predict. Run it from the
+root of the repo, e.g.:
+    python 2a_model/src/models/benchmark_startup.py -s 2a_model/src/models/0_baseline_LSTM/Snakefile
+
+Run it on two commits to compare them; the tensorflow import time is roughly
+what every rule used to pay before tensorflow was imported lazily.
+"""
+import argparse
+import subprocess
+import sys
+import time
+
+
+NON_TRAINING_RULES = ["base_make_partitioned_predictions",
+                      "base_combine_metrics",
+                      "base_exp_metrics"]
+
+
+def time_command(cmd, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-s", "--snakefile", required=True)
+    parser.add_argument("--cores", default="1")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--rerun", action="store_true",
+                        help="also time a forced rerun of the non-training rules")
+    args = parser.parse_args()
+
+    snakemake = [sys.executable, "-m", "snakemake", "-s", args.snakefile,
+                 "--cores", args.cores]
+    timings = {
+        "import tensorflow": time_command([sys.executable, "-c", "import tensorflow"],
+                                          args.repeat),
+        "dry run": time_command(snakemake + ["-n"], args.repeat),
+    }
+    if args.rerun:
+        timings["non-training rerun"] = time_command(
+            snakemake + ["--forcerun"] + NON_TRAINING_RULES, 1)
+
+    for name, seconds in timings.items():
+        print(f"{name:>20}: {seconds:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
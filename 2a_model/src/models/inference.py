@@ -0,0 +1,227 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+import xarray as xr
+from tensorflow.keras import layers
+
+from river_dl.predict import predict_from_arbitrary_data
+from training import build_model
+
+
+class EnsembleModel(tf.keras.Model):
+    """
+    Runs the replicates of a model (e.g., LSTMModel or LSTMModel2Dense) as one
+    model. The predictions of the members are concatenated along the last
+    (task) axis, so a single forward pass over the inputs gives the predictions
+    of every replicate
+    """
+    def __init__(self, members):
+        """
+        :param members: [list] models with the same architecture, one per replicate
+        """
+        super().__init__()
+        self.members = members
+
+    @tf.function
+    def call(self, inputs):
+        return tf.concat([member(inputs) for member in self.members], axis=-1)
+
+
+def rep_var_name(var, rep):
+    return f"{var}__rep{rep}"
+
+
+# the per output variable entries of prepped.npz, repeated for every replicate
+ENSEMBLE_TILED_KEYS = ["y_mean", "y_std"]
+
+
+def make_ensemble_io_data(train_io_data, reps, out_file):
+    """
+    write a copy of the prepped io data with the output variables (y_obs_vars)
+    and their means and stds (ENSEMBLE_TILED_KEYS) repeated for every
+    replicate, to go with the concatenated predictions of EnsembleModel
+    :param train_io_data: [str] path to the prepped.npz file
+    :param reps: [list] replicate ids
+    :param out_file: [str] path to write the new npz file to
+    """
+    io_data = dict(np.load(train_io_data, allow_pickle=True))
+    y_vars = io_data["y_obs_vars"]
+    for key in ENSEMBLE_TILED_KEYS:
+        if key in io_data:
+            io_data[key] = np.tile(io_data[key], len(reps))
+    io_data["y_obs_vars"] = np.array([rep_var_name(v, r) for r in reps for v in y_vars])
+    np.savez_compressed(out_file, **io_data)
+
+
+def predict_ensemble(model_spec, weight_dirs, train_io_data, raw_data_file,
+                     pred_start_date, pred_end_date, spatial_idx_name="site_id",
+                     time_idx_name="date"):
+    """
+    make predictions with every replicate of a holdout in one pass. The inputs
+    are read and normalized once and all of the replicates are run as a single
+    EnsembleModel
+    :param model_spec: [dict] one replicate of the model (see training.build_model)
+    :param weight_dirs: [dict] weight directory of each replicate, keyed by rep id
+    :param train_io_data: [str] path to the prepped.npz file
+    :param raw_data_file: [str] path to the io zarr
+    :param pred_start_date: [str] first date to predict
+    :param pred_end_date: [str] last date to predict
+    :return: [tuple of DataFrames] the predictions of each replicate (with a rep
+    column) and the ensemble mean and standard deviation of each variable
+    """
+    reps = list(weight_dirs.keys())
+    members = []
+    for rep in reps:
+        member = build_model(model_spec)
+        member.load_weights(os.path.join(weight_dirs[rep], ""))
+        members.append(member)
+    model = EnsembleModel(members)
+
+    y_vars = list(np.load(train_io_data, allow_pickle=True)["y_obs_vars"])
+    idx_cols = [spatial_idx_name, time_idx_name]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ensemble_io_data = os.path.join(tmp_dir, "ensemble_prepped.npz")
+        make_ensemble_io_data(train_io_data, reps, ensemble_io_data)
+        preds_wide = predict_from_arbitrary_data(raw_data_file=raw_data_file,
+                                                 pred_start_date=pred_start_date,
+                                                 pred_end_date=pred_end_date,
+                                                 train_io_data=ensemble_io_data,
+                                                 model=model,
+                                                 spatial_idx_name=spatial_idx_name,
+                                                 time_idx_name=time_idx_name)
+    preds_wide = preds_wide.reset_index(drop=True)
+
+    rep_preds = []
+    for rep in reps:
+        preds_rep = preds_wide[idx_cols + [rep_var_name(v, rep) for v in y_vars]]
+        preds_rep = preds_rep.rename(columns={rep_var_name(v, rep): v for v in y_vars})
+        preds_rep["rep"] = rep
+        rep_preds.append(preds_rep)
+    rep_preds = pd.concat(rep_preds, ignore_index=True)
+
+    stats = rep_preds.groupby(idx_cols)[y_vars].agg(["mean", "std"])
+    stats.columns = [f"{var}_{stat}" for var, stat in stats.columns]
+    return rep_preds, stats.reset_index()
+
+
+def prep_continuous_inputs(train_io_data, raw_data_file, pred_start_date,
+                           pred_end_date, spatial_idx_name="site_id",
+                           time_idx_name="date"):
+    """
+    read and normalize the inputs as one continuous sequence per site (instead
+    of the 365-day sequences that prep_all_data makes)
+    :param train_io_data: [str] path to the prepped.npz file (for the x_vars and
+    their means and stds)
+    :param raw_data_file: [str] path to the io zarr
+    :param pred_start_date: [str] first date to predict
+    :param pred_end_date: [str] last date to predict
+    :return: [tuple] inputs [n_sites, n_dates, n_x_vars], site ids and dates
+    """
+    io_data = np.load(train_io_data, allow_pickle=True)
+    x_vars = list(io_data["x_vars"])
+    ds = xr.open_zarr(raw_data_file)[x_vars]
+    ds = ds.sel({time_idx_name: slice(pred_start_date, pred_end_date)})
+    x = ds.to_array().transpose(spatial_idx_name, time_idx_name, "variable").values
+    x = (x - io_data["x_mean"]) / io_data["x_std"]
+    return (x.astype(np.float32), ds[spatial_idx_name].values,
+            ds[time_idx_name].values)
+
+
+class StreamingLSTM:
+    """
+    Runs a trained model (e.g., LSTMModel or LSTMModel2Dense) over long
+    sequences in fixed length chunks, carrying the LSTM states (h and c) from
+    one chunk to the next. Compute is linear in the length of the sequences and
+    memory is bounded by the chunk length
+    """
+    def __init__(self, model, chunk_len=365):
+        """
+        :param model: [tf.keras.Model] trained model with an `rnn_layer` (LSTM)
+        and an `output_head` method. The model has to have been built (e.g.,
+        called on some data or had its weights loaded)
+        :param chunk_len: [int] number of time steps run at a time
+        """
+        self.model = model
+        self.chunk_len = chunk_len
+        self.units = model.rnn_layer.units
+        # same weights as the model's LSTM, but returning its final states
+        self.rnn_layer = layers.LSTM(self.units, return_sequences=True,
+                                     return_state=True)
+        self._step = tf.function(self._run_chunk, reduce_retracing=True)
+
+    def _run_chunk(self, x_chunk, h, c):
+        h_seq, h, c = self.rnn_layer(x_chunk, initial_state=[h, c])
+        return self.model.output_head(h_seq), h, c
+
+    def predict(self, x, reset_every=None):
+        """
+        :param x: [array] normalized inputs [n_sites, n_dates, n_x_vars]
+        :param reset_every: [int] reset the states to zero every this many time
+        steps. With the sequence length used in training (365) the predictions
+        are the same as the ones from predict_from_arbitrary_data. With None
+        (default) the states are carried over the whole sequence
+        :return: [array] predictions [n_sites, n_dates, n_outputs]
+        """
+        x = np.asarray(x, dtype=np.float32)
+        n_sites, n_dates, n_x_vars = x.shape
+        if not self.rnn_layer.built:
+            self.rnn_layer.build((None, None, n_x_vars))
+            self.rnn_layer.set_weights(self.model.rnn_layer.get_weights())
+
+        chunk_len = self.chunk_len
+        if reset_every:
+            # chunks can't span a reset
+            chunk_len = min(chunk_len, reset_every)
+        zeros = tf.zeros((n_sites, self.units))
+        h, c = zeros, zeros
+        preds = []
+        start = 0
+        while start < n_dates:
+            if reset_every and start % reset_every == 0:
+                h, c = zeros, zeros
+            end = min(start + chunk_len, n_dates)
+            if reset_every:
+                end = min(end, (start // reset_every + 1) * reset_every)
+            y_chunk, h, c = self._step(tf.constant(x[:, start:end]), h, c)
+            preds.append(y_chunk.numpy())
+            start = end
+        return np.concatenate(preds, axis=1)
+
+
+def predict_streaming(model, train_io_data, raw_data_file, pred_start_date,
+                      pred_end_date, chunk_len=365, reset_every=None,
+                      spatial_idx_name="site_id", time_idx_name="date"):
+    """
+    make one continuous prediction per site over the whole prediction period
+    with StreamingLSTM, instead of predicting overlapping 365-day sequences and
+    stitching them together
+    :param model: [tf.keras.Model] trained model (weights loaded)
+    :param train_io_data: [str] path to the prepped.npz file
+    :param raw_data_file: [str] path to the io zarr
+    :param pred_start_date: [str] first date to predict
+    :param pred_end_date: [str] last date to predict
+    :param chunk_len: [int] number of time steps run at a time
+    :param reset_every: [int] reset the LSTM states every this many time steps
+    (see StreamingLSTM.predict)
+    :return: [DataFrame] predictions with the same columns as the ones from
+    predict_from_arbitrary_data
+    """
+    x, sites, dates = prep_continuous_inputs(train_io_data, raw_data_file,
+                                             pred_start_date, pred_end_date,
+                                             spatial_idx_name, time_idx_name)
+    # build the model so that its weights can be copied
+    model(x[:, :1])
+    y = StreamingLSTM(model, chunk_len).predict(x, reset_every=reset_every)
+
+    io_data = np.load(train_io_data, allow_pickle=True)
+    if "y_std" in io_data and "y_mean" in io_data:
+        y = y * io_data["y_std"] + io_data["y_mean"]
+    n_sites, n_dates, n_outputs = y.shape
+    preds = pd.DataFrame(y.reshape(-1, n_outputs),
+                         columns=list(io_data["y_obs_vars"]))
+    preds.insert(0, spatial_idx_name, np.repeat(sites, n_dates))
+    preds.insert(1, time_idx_name, np.tile(dates, n_sites))
+    return preds
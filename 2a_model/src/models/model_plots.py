@@ -1,3 +1,9 @@
+import multiprocessing
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+import matplotlib.dates as mdates
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -37,3 +43,121 @@ def plot_obs_preds(pred_file, obs_file, site_id, start_date, end_date,
                     bbox={'facecolor': 'white', 'pad': 10})
     if outfile:
         plt.savefig(outfile, dpi=300, bbox_inches='tight')
+
+
+def _add_info_text(fig, info_dict):
+    info_text = "\n".join([f"{key}: {val}" for key, val in info_dict.items()])
+    return fig.text(0.9,
+                    0.05,
+                    info_text,
+                    ha='left',
+                    va='bottom',
+                    bbox={'facecolor': 'white', 'pad': 10})
+
+
+# one figure per worker (and number of variables), cleared and redrawn for
+# every panel instead of making a new figure each time
+_FIGURES = {}
+
+
+def _get_figure(n_vars):
+    if n_vars not in _FIGURES:
+        fig, axs = plt.subplots(n_vars, 1, figsize=(5, 1.4*n_vars), sharex=True,
+                                squeeze=False)
+        fig.subplots_adjust(hspace=0.5)
+        _FIGURES[n_vars] = (fig, axs[:, 0])
+    return _FIGURES[n_vars]
+
+
+def _init_plot_worker():
+    # non-interactive backend, the figures are only written to files
+    matplotlib.use("Agg")
+
+
+def _plot_site_panels(df_pred_site, df_obs_site, panels):
+    """
+    draw the obs/preds panels of one site on a reused figure
+    :param df_pred_site: [DataFrame] predictions of the site indexed by date
+    :param df_obs_site: [DataFrame] observations of the site indexed by date
+    (same columns as df_pred_site)
+    :param panels: [list of tuples] (start_date, end_date, outfile, info_dict)
+    """
+    variables = list(df_pred_site.columns)
+    fig, axs = _get_figure(len(variables))
+    for start_date, end_date, outfile, info_dict in panels:
+        obs = df_obs_site.loc[start_date: end_date]
+        pred = df_pred_site.loc[start_date: end_date]
+        for ax, var in zip(axs, variables):
+            ax.cla()
+            ax.plot(obs.index, obs[var], color="black", label="obs")
+            ax.plot(pred.index, pred[var], color="steelblue", label="pred")
+            ax.set_title(f"variable = {var}", fontsize="small")
+            ax.set_ylabel("value")
+        locator = mdates.AutoDateLocator()
+        axs[-1].xaxis.set_major_locator(locator)
+        axs[-1].xaxis.set_major_formatter(mdates.ConciseDateFormatter(locator))
+        axs[-1].set_xlabel("date")
+        legend = fig.legend(*axs[0].get_legend_handles_labels(), title="type",
+                            loc="center left", bbox_to_anchor=(1, 0.5))
+        text = _add_info_text(fig, info_dict) if info_dict else None
+        fig.savefig(outfile, dpi=300, bbox_inches='tight')
+        legend.remove()
+        if text:
+            text.remove()
+    return len(panels)
+
+
+def plot_obs_preds_batch(pred_file, obs_file, panels, n_workers=None):
+    """
+    plot many (site, date range) obs/preds panels of one set of predictions.
+    The predictions and observations are read once and sliced in memory and
+    the panels are drawn in a pool of workers (one task per site) with a
+    non-interactive backend, reusing one figure per worker. The panels have
+    the layout of plot_obs_preds (one row per variable, obs in black and preds
+    in steelblue, the info text on the right) drawn with plain matplotlib, not
+    seaborn, so they don't look exactly the same. Sites that are missing from
+    the predictions or the observations are skipped with a warning
+    :param pred_file: [str] path to the preds.feather file
+    :param obs_file: [str] path to the observations zarr
+    :param panels: [list of dicts] with the "site_id", "start_date",
+    "end_date" and "outfile" of each panel and, optionally, its "info_dict"
+    :param n_workers: [int] number of worker processes, defaults to the number
+    of cpus
+    :return: [int] number of panels that were drawn
+    """
+    df_pred = pd.read_feather(pred_file)
+    df_pred['site_id'] = df_pred['site_id'].astype(str)
+    variables = [c for c in df_pred.columns if c not in ('site_id', 'date')]
+    site_ids = sorted({panel['site_id'] for panel in panels})
+    ds_obs = xr.open_zarr(obs_file)[variables]
+    obs_site_ids = set(ds_obs['site_id'].values.astype(str))
+    ds_obs = ds_obs.sel(site_id=[site for site in site_ids if site in obs_site_ids])
+    df_obs = ds_obs.to_dataframe().reset_index()
+    df_obs['site_id'] = df_obs['site_id'].astype(str)
+
+    pred_sites = {site: df.set_index('date')[variables]
+                  for site, df in df_pred[df_pred['site_id'].isin(site_ids)].groupby('site_id')}
+    obs_sites = {site: df.set_index('date')[variables]
+                 for site, df in df_obs.groupby('site_id')}
+    site_panels = {}
+    for panel in panels:
+        site_panels.setdefault(panel['site_id'], []).append(
+            (panel['start_date'], panel['end_date'], panel['outfile'],
+             panel.get('info_dict')))
+
+    skipped = [site for site in site_panels
+               if site not in pred_sites or site not in obs_sites]
+    if skipped:
+        warnings.warn(f"no predictions or observations for sites {skipped}, "
+                      "their panels are not drawn")
+
+    n_workers = min(n_workers or multiprocessing.cpu_count(), len(site_panels))
+    with ProcessPoolExecutor(max(n_workers, 1),
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_plot_worker) as executor:
+        futures = [executor.submit(_plot_site_panels, pred_sites[site],
+                                   obs_sites[site], site_panels[site])
+                   for site in site_panels
+                   if site not in skipped]
+        return sum(f.result() for f in futures)
+
@@ -0,0 +1,87 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+# the store is a hive partitioned parquet dataset:
+# {store_dir}/model={model}/holdout={holdout}/rep={rep}/preds.parquet
+PARTITIONING = ds.partitioning(
+    pa.schema([("model", pa.string()),
+               ("holdout", pa.string()),
+               ("rep", pa.int32())]),
+    flavor="hive",
+)
+
+
+def get_store_file(store_dir, model, holdout, rep):
+    return os.path.join(store_dir, f"model={model}", f"holdout={holdout}",
+                        f"rep={rep}", "preds.parquet")
+
+
+def write_preds_to_store(preds, store_dir, model, holdout, rep,
+                         row_group_size=4096):
+    """
+    add the predictions of one model/holdout/rep to the store, replacing any
+    predictions that were there for it before. The rows are sorted by site and
+    date so the row group statistics can be used to skip row groups when
+    reading a subset of sites or dates
+    :param preds: [DataFrame or str] predictions (or the path to a preds.feather
+    file) with site_id and date columns
+    :param store_dir: [str] root directory of the store
+    :param model: [str] model name (e.g., '0_baseline_LSTM')
+    :param holdout: [str] holdout id
+    :param rep: [int] replicate number
+    :param row_group_size: [int] number of rows in each parquet row group
+    :return: [str] path to the file that was written
+    """
+    if isinstance(preds, str):
+        preds = pd.read_feather(preds)
+    preds = preds.sort_values(["site_id", "date"])
+    out_file = get_store_file(store_dir, model, holdout, rep)
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    pq.write_table(pa.Table.from_pandas(preds, preserve_index=False), out_file,
+                   row_group_size=row_group_size)
+    return out_file
+
+
+def _isin_or_equal(field, values):
+    if isinstance(values, (list, tuple)):
+        return ds.field(field).isin(values)
+    return ds.field(field) == values
+
+
+def read_preds_from_store(store_dir, model=None, holdout=None, rep=None,
+                          site_id=None, start_date=None, end_date=None,
+                          columns=None):
+    """
+    read predictions from the store. All of the filters are pushed down to the
+    dataset, so only the matching partitions and row groups are read (e.g., all
+    of the reps of one site for one model)
+    :param store_dir: [str] root directory of the store
+    :param model: [str or list] model name(s) to read
+    :param holdout: [str or list] holdout id(s) to read
+    :param rep: [int or list] replicate(s) to read
+    :param site_id: [str or list] site(s) to read
+    :param start_date: [str] first date to read (inclusive)
+    :param end_date: [str] last date to read (exclusive)
+    :param columns: [list] columns to read, defaults to all of them
+    :return: [DataFrame] predictions with model, holdout and rep columns
+    """
+    dataset = ds.dataset(store_dir, format="parquet", partitioning=PARTITIONING)
+    filters = []
+    for field, values in [("model", model), ("holdout", holdout), ("rep", rep),
+                          ("site_id", site_id)]:
+        if values is not None:
+            filters.append(_isin_or_equal(field, values))
+    if start_date:
+        filters.append(ds.field("date") >= pd.Timestamp(start_date))
+    if end_date:
+        filters.append(ds.field("date") < pd.Timestamp(end_date))
+
+    expression = None
+    for f in filters:
+        expression = f if expression is None else expression & f
+    return dataset.to_table(filter=expression, columns=columns).to_pandas()
@@ -0,0 +1,347 @@
+import contextlib
+import datetime
+import importlib
+import math
+import multiprocessing
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from utils import load_prepped
+
+
+def _tracing_count(func):
+    if hasattr(func, "experimental_get_tracing_count"):
+        return func.experimental_get_tracing_count()
+    return np.nan
+
+
+def _rss_mb():
+    """
+    current resident memory of the process. Falls back to the lifetime peak
+    (ru_maxrss) where /proc isn't available
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        # ru_maxrss is in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class TrainingPerfCallback(tf.keras.callbacks.Callback):
+    """
+    records the wall time, number of steps, steps per second, peak memory (RSS)
+    and how many times the model's call has been traced for every epoch.
+    Optionally profiles some of the epochs with the tensorflow profiler. The
+    peak memory is sampled after every batch and the tracings are counted from
+    the start of the run, so both are for this training run, not for the
+    process (which may have trained other models before, see train_many)
+    """
+    def __init__(self, perf_file=None, summary_file=None, profile_dir=None,
+                 profile_epochs=(1,)):
+        """
+        :param perf_file: [str] csv file to write the per epoch records to
+        :param summary_file: [str] csv file to write a one row summary of the
+        whole training run to
+        :param profile_dir: [str] directory to write tensorflow profiler traces
+        to. No profiling if None
+        :param profile_epochs: [tuple] epochs to profile (the first epoch, 0,
+        includes the tracing)
+        """
+        super().__init__()
+        self.perf_file = perf_file
+        self.summary_file = summary_file
+        self.profile_dir = profile_dir
+        self.profile_epochs = profile_epochs
+        self.records = []
+
+    def _call_tracing_count(self):
+        return _tracing_count(getattr(self.model, "call", None))
+
+    def on_train_begin(self, logs=None):
+        self.records = []
+        self.train_start = time.perf_counter()
+        self.train_peak_rss = _rss_mb()
+        self.train_tracing_count = self._call_tracing_count()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        if self.profile_dir and epoch in self.profile_epochs:
+            tf.profiler.experimental.start(self.profile_dir)
+        self.steps = 0
+        self.epoch_peak_rss = _rss_mb()
+        self.epoch_tracing_count = self._call_tracing_count()
+        self.epoch_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.steps += 1
+        self.epoch_peak_rss = max(self.epoch_peak_rss, _rss_mb())
+
+    def on_epoch_end(self, epoch, logs=None):
+        epoch_time = time.perf_counter() - self.epoch_start
+        self.train_peak_rss = max(self.train_peak_rss, self.epoch_peak_rss)
+        if self.profile_dir and epoch in self.profile_epochs:
+            tf.profiler.experimental.stop()
+        self.records.append({"epoch": epoch,
+                             "epoch_time_s": epoch_time,
+                             "steps": self.steps,
+                             "steps_per_s": self.steps / epoch_time,
+                             "peak_rss_mb": self.epoch_peak_rss,
+                             "call_tracings": (self._call_tracing_count() -
+                                               self.epoch_tracing_count)})
+
+    def summary(self):
+        """
+        :return: [dict] totals for the training run. The first epoch is kept
+        out of the means because it includes the tracing
+        """
+        epochs = pd.DataFrame(self.records, columns=["epoch", "epoch_time_s",
+                                                     "steps", "steps_per_s"])
+        later = epochs.iloc[1:]
+        return {"n_epochs": len(epochs),
+                "train_time_s": time.perf_counter() - self.train_start,
+                "first_epoch_time_s": epochs["epoch_time_s"].iloc[0] if len(epochs) else np.nan,
+                "mean_epoch_time_s": later["epoch_time_s"].mean(),
+                "mean_steps_per_s": later["steps_per_s"].mean(),
+                "peak_rss_mb": max(self.train_peak_rss, _rss_mb()),
+                "call_tracings": self._call_tracing_count() - self.train_tracing_count}
+
+    def on_train_end(self, logs=None):
+        if self.perf_file:
+            columns = ["epoch", "epoch_time_s", "steps", "steps_per_s",
+                       "peak_rss_mb", "call_tracings"]
+            pd.DataFrame(self.records, columns=columns).to_csv(self.perf_file,
+                                                               index=False)
+        if self.summary_file:
+            pd.DataFrame([self.summary()]).to_csv(self.summary_file, index=False)
+
+
+@contextlib.contextmanager
+def fit_callbacks(model, callbacks):
+    """
+    adds callbacks to every model.fit call made in the with block, for training
+    functions that don't take callbacks (e.g., river_dl's train_model)
+    :param model: [tf.keras.Model] the model that is trained in the block
+    :param callbacks: [list] keras callbacks
+    """
+    fit = model.fit
+
+    def fit_with_callbacks(*args, **kwargs):
+        kwargs["callbacks"] = list(kwargs.get("callbacks") or []) + list(callbacks)
+        return fit(*args, **kwargs)
+
+    model.fit = fit_with_callbacks
+    try:
+        yield model
+    finally:
+        del model.fit
+
+
+def split_windows(arr, window_len):
+    """
+    split each sequence into consecutive windows
+    :param arr: [array] sequences [n_seqs, seq_len, n_vars]
+    :param window_len: [int] length of the windows. Has to divide seq_len
+    :return: [array] windows [n_seqs * seq_len / window_len, window_len, n_vars]
+    """
+    n_seqs, seq_len, n_vars = arr.shape
+    if seq_len % window_len:
+        raise ValueError(f"window_len ({window_len}) has to divide the "
+                         f"sequence length ({seq_len})")
+    return arr.reshape(n_seqs * seq_len // window_len, window_len, n_vars)
+
+
+def make_dataset(x, y, batch_size, window_len=None, shuffle=True, seed=None):
+    """
+    tf.data pipeline for training. Every batch has the same shape (the
+    dataset is repeated and the last, partial, batch of each pass is dropped),
+    so the model's train step is only traced once
+    :param x: [array] inputs [n_seqs, seq_len, n_x_vars]
+    :param y: [array] observations [n_seqs, seq_len, n_y_vars]
+    :param batch_size: [int] number of sequences (or windows) per batch
+    :param window_len: [int] if given, the sequences are split into windows
+    of this length and the windows are batched (and shuffled) instead
+    :param shuffle: [bool] whether to shuffle the sequences every epoch
+    :param seed: [int] seed for the shuffling
+    :return: [tuple] the dataset and the number of steps per epoch
+    """
+    x = np.asarray(x, dtype=np.float32)
+    y = np.asarray(y, dtype=np.float32)
+    if window_len:
+        x = split_windows(x, window_len)
+        y = split_windows(y, window_len)
+    n_samples = x.shape[0]
+    batch_size = min(batch_size, n_samples)
+
+    dataset = tf.data.Dataset.from_tensor_slices((x, y))
+    if shuffle:
+        dataset = dataset.shuffle(n_samples, seed=seed,
+                                  reshuffle_each_iteration=True)
+    dataset = dataset.repeat().batch(batch_size, drop_remainder=True)
+    dataset = dataset.prefetch(tf.data.AUTOTUNE)
+    steps_per_epoch = math.ceil(n_samples / batch_size)
+    return dataset, steps_per_epoch
+
+
+def train_model_tf_data(model, x_trn, y_trn, epochs, batch_size,
+                        weight_dir=None, log_file=None, time_file=None,
+                        early_stop_patience=None, window_len=None,
+                        shuffle=True, seed=None, callbacks=None):
+    """
+    train a compiled model with a tf.data input pipeline (see make_dataset).
+    Writes the same weights, log and time files as river_dl's train_model
+    :param model: [tf.keras.Model] compiled model
+    :param x_trn: [array] training inputs [n_seqs, seq_len, n_x_vars]
+    :param y_trn: [array] training observations [n_seqs, seq_len, n_y_vars]
+    :param epochs: [int] number of epochs
+    :param batch_size: [int] number of sequences (or windows) per batch
+    :param weight_dir: [str] directory to save the trained weights to
+    :param log_file: [str] csv file to log the loss of each epoch to
+    :param time_file: [str] file to write the training time to
+    :param early_stop_patience: [int] stop if the training loss hasn't improved
+    in this many epochs
+    :param window_len: [int] split the sequences into windows of this length
+    :param shuffle: [bool] whether to shuffle the batches every epoch
+    :param seed: [int] seed for the shuffling
+    :param callbacks: [list] additional keras callbacks
+    :return: [tf.keras.Model] the trained model
+    """
+    dataset, steps_per_epoch = make_dataset(x_trn, y_trn, batch_size,
+                                            window_len=window_len,
+                                            shuffle=shuffle, seed=seed)
+    callbacks = list(callbacks) if callbacks else []
+    if log_file:
+        callbacks.append(tf.keras.callbacks.CSVLogger(log_file))
+    if early_stop_patience:
+        callbacks.append(tf.keras.callbacks.EarlyStopping(
+            monitor="loss", patience=early_stop_patience))
+
+    start_time = datetime.datetime.now()
+    model.fit(dataset, epochs=epochs, steps_per_epoch=steps_per_epoch,
+              callbacks=callbacks)
+    train_time = datetime.datetime.now() - start_time
+
+    if weight_dir:
+        model.save_weights(weight_dir)
+    if time_file:
+        with open(time_file, "a") as f:
+            f.write(f"elapsed training time: {train_time}\n")
+    return model
+
+
+def compile_and_train(model, prepped, weight_dir, log_file, time_file, config,
+                      perf_file=None, perf_summary_file=None, profile_dir=None):
+    """
+    compile and train one model (one holdout and replicate) the way the train
+    rule does
+    :param model: [tf.keras.Model] untrained model
+    :param prepped: [str] path to the prepped arrays (directory or npz)
+    :param weight_dir: [str] directory to save the trained weights to
+    :param log_file: [str] csv file to log the loss of each epoch to
+    :param time_file: [str] file to write the training time to
+    :param config: [dict] the workflow config
+    :param perf_file: [str] csv file for the per epoch TrainingPerfCallback
+    records
+    :param perf_summary_file: [str] csv file for the TrainingPerfCallback
+    summary
+    :param profile_dir: [str] directory for tensorflow profiler traces
+    """
+    from river_dl.train import train_model
+    from river_dl import loss_functions as lf
+
+    loss_function = lf.multitask_rmse(config['lambdas'])
+    optimizer = tf.optimizers.Adam(learning_rate=config['finetune_learning_rate'])
+    model.compile(optimizer=optimizer, loss=loss_function)
+    # memory-mapped, so only x_trn, y_obs_trn and ids_trn are read
+    data = load_prepped(prepped)
+    nsegs = len(np.unique(data["ids_trn"]))
+    perf_callback = TrainingPerfCallback(perf_file, perf_summary_file, profile_dir)
+    if config.get('use_tf_data', False):
+        train_model_tf_data(model,
+                            x_trn=data['x_trn'],
+                            y_trn=data['y_obs_trn'],
+                            epochs=config['epochs'],
+                            batch_size=config.get('train_batch_size') or nsegs,
+                            weight_dir=weight_dir,
+                            log_file=log_file,
+                            time_file=time_file,
+                            early_stop_patience=config['early_stopping'],
+                            window_len=config.get('train_window_len'),
+                            seed=config['seed'] or None,
+                            callbacks=[perf_callback])
+    else:
+        # river_dl's train_model doesn't take callbacks, so the callback is
+        # added to its model.fit call
+        with fit_callbacks(model, [perf_callback]):
+            train_model(model,
+                        x_trn=data['x_trn'],
+                        y_trn=data['y_obs_trn'],
+                        epochs=config['epochs'],
+                        batch_size=nsegs,
+                        weight_dir=weight_dir,
+                        log_file=log_file,
+                        time_file=time_file,
+                        early_stop_patience=config['early_stopping'])
+
+
+def build_model(model_spec):
+    """
+    :param model_spec: [dict] "module" and "class_name" of the model class and
+    the "kwargs" to make it with, e.g., {"module": "model", "class_name":
+    "LSTMModel", "kwargs": {"hidden_size": 10, "num_tasks": 3}}
+    :return: [tf.keras.Model] a new, untrained, model
+    """
+    model_class = getattr(importlib.import_module(model_spec["module"]),
+                          model_spec["class_name"])
+    return model_class(**model_spec["kwargs"])
+
+
+def _init_worker(threads_per_worker):
+    # has to be set before tensorflow runs any ops in the worker
+    tf.config.threading.set_intra_op_parallelism_threads(threads_per_worker)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def _train_job(model_spec, config, job):
+    tf.keras.backend.clear_session()
+    model = build_model(model_spec)
+    compile_and_train(model, job["prepped"], job["weight_dir"], job["log_file"],
+                      job["time_file"], config,
+                      perf_file=job.get("perf_file"),
+                      perf_summary_file=job.get("perf_summary_file"),
+                      profile_dir=job.get("profile_dir"))
+    return job["weight_dir"]
+
+
+def train_many(jobs, model_spec, config, n_workers=None, threads_per_worker=1):
+    """
+    train many models (e.g., every holdout and replicate of an experiment) in a
+    pool of long-lived worker processes. Each worker imports tensorflow once and
+    runs its share of the jobs one after the other, with its tensorflow threads
+    pinned to threads_per_worker
+    :param jobs: [list of dicts] one per model with the "prepped" arrays and the
+    "weight_dir", "log_file" and "time_file" to write, and optionally the
+    "perf_file", "perf_summary_file" and "profile_dir" (see compile_and_train)
+    :param model_spec: [dict] the model to train (see build_model)
+    :param config: [dict] the workflow config
+    :param n_workers: [int] number of worker processes, defaults to the number
+    of cpus divided by threads_per_worker
+    :param threads_per_worker: [int] tensorflow intra-op threads per worker
+    :return: [list] the weight directories, in the same order as the jobs
+    """
+    if not n_workers:
+        n_workers = max(1, multiprocessing.cpu_count() // threads_per_worker)
+    n_workers = min(n_workers, len(jobs))
+    with ProcessPoolExecutor(n_workers,
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker,
+                             initargs=(threads_per_worker,)) as executor:
+        futures = [executor.submit(_train_job, model_spec, config, job)
+                   for job in jobs]
+        return [f.result() for f in futures]
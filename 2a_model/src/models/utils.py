@@ -1,3 +1,9 @@
+import json
+import os
+from collections.abc import Mapping
+
+import numpy as np
+
 
 def get_holdouts(config):
     return config['validation_sites_nonurban'] + ['1_urban', '2_urban', 'temporal']
@@ -27,4 +33,74 @@ def get_train_val(holdout, config):
     return trn_end, val_start, val_end, val_sites
 
 
+PREPPED_MANIFEST = "manifest.json"
+
+
+def write_prepped_arrays(prepped_npz, out_dir):
+    """
+    write the arrays of a prepped.npz file as one uncompressed .npy file per
+    array plus a json manifest, so they can be memory-mapped (see load_prepped)
+    without unpickling anything. Object arrays (e.g., the site ids and variable
+    names) are stored as fixed-width strings
+    :param prepped_npz: [str] path to the prepped.npz file
+    :param out_dir: [str] directory to write the arrays and manifest to
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = {}
+    with np.load(prepped_npz, allow_pickle=True) as data:
+        for key in data.files:
+            arr = data[key]
+            # e.g., x_val when there is no validation data
+            if arr.dtype == object and arr.ndim == 0 and arr.item() is None:
+                manifest[key] = None
+                continue
+            if arr.dtype == object:
+                arr = arr.astype(str)
+            file_name = f"{key}.npy"
+            np.save(os.path.join(out_dir, file_name), arr, allow_pickle=False)
+            manifest[key] = {"file": file_name,
+                             "dtype": arr.dtype.str,
+                             "shape": list(arr.shape)}
+    with open(os.path.join(out_dir, PREPPED_MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+class PreppedArrays(Mapping):
+    """
+    read-only, dict-like access to the arrays written by write_prepped_arrays.
+    An array is only opened (memory-mapped) the first time it's accessed
+    """
+    def __init__(self, prepped_dir, mmap_mode="r"):
+        self.prepped_dir = prepped_dir
+        self.mmap_mode = mmap_mode
+        with open(os.path.join(prepped_dir, PREPPED_MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self._arrays = {}
+
+    def __getitem__(self, key):
+        entry = self.manifest[key]
+        if entry is None:
+            return None
+        if key not in self._arrays:
+            self._arrays[key] = np.load(os.path.join(self.prepped_dir, entry["file"]),
+                                        mmap_mode=self.mmap_mode,
+                                        allow_pickle=False)
+        return self._arrays[key]
+
+    def __iter__(self):
+        return iter(self.manifest)
+
+    def __len__(self):
+        return len(self.manifest)
+
 
+def load_prepped(prepped, mmap_mode="r"):
+    """
+    :param prepped: [str] path to a directory written by write_prepped_arrays
+    or to a prepped.npz file
+    :param mmap_mode: [str] passed to np.load for the .npy arrays
+    :return: [Mapping] the prepped arrays, keyed by name
+    """
+    if os.path.isdir(prepped):
+        return PreppedArrays(prepped, mmap_mode=mmap_mode)
+    return np.load(prepped, allow_pickle=True)
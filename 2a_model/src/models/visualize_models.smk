@@ -1,4 +1,6 @@
-from model_plots import plot_obs_preds
+import os
+import pandas as pd
+from model_plots import plot_obs_preds, plot_obs_preds_batch
 
 rule make_obs_preds_plots:
     input:
@@ -23,6 +25,45 @@ rule make_obs_preds_plots:
                        outfile=output[0],
                        info_dict=info_dict
                        )
-        
-     
-    
+
+
+# all of the site/year obs/preds plots of one replicate in one job, from one
+# read of the predictions and observations, written to one directory. The
+# panels have the layout of make_obs_preds_plots but are drawn with plain
+# matplotlib (see model_plots.plot_obs_preds_batch)
+rule make_obs_preds_plots_rep:
+    input:
+        pred_file="{outdir}/holdout_{holdout}/rep_{rep}/preds.feather",
+        obs_file=f"../../../out/well_obs_io.zarr",
+    output:
+        directory("{outdir}/holdout_{holdout}/rep_{rep}/obs_preds_plots")
+    threads: workflow.cores
+    run:
+        os.makedirs(output[0], exist_ok=True)
+        df_pred = pd.read_feather(input.pred_file, columns=["site_id", "date"])
+        years = pd.to_datetime(df_pred["date"]).dt.year.unique()
+        panels = []
+        for site_id in df_pred["site_id"].astype(str).unique():
+            for year in years:
+                info_dict = {"exp id": config["exp_name"],
+                             "holdout": wildcards.holdout,
+                             "rep id": wildcards.rep,
+                             "site id": site_id}
+                panels.append(dict(site_id=site_id,
+                                   start_date=f"{year}-01-01",
+                                   end_date=f"{year}-12-31",
+                                   outfile=os.path.join(output[0],
+                                                        f"ts_{site_id}_{year}.png"),
+                                   info_dict=info_dict))
+        plot_obs_preds_batch(input.pred_file, input.obs_file, panels,
+                             n_workers=threads)
+
+
+# the obs/preds plots of every holdout and replicate. Not part of the default
+# target, run it on request, e.g., `snakemake base_plot_obs_preds_all`
+rule plot_obs_preds_all:
+    input:
+        expand("{outdir}/holdout_{holdout}/rep_{rep}/obs_preds_plots",
+               outdir=out_dir,
+               holdout=get_holdouts(config),
+               rep=list(range(config['num_replicates'])))
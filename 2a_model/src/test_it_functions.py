@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""
+checks every hot path case of benchmark_it_functions.py against the frozen
+baselines (benchmark_baselines.npz), run from 2a_model/src with:
+    python -m pytest test_it_functions.py
+"""
+import numpy as np
+import pytest
+
+import benchmark_it_functions as bench
+
+
+@pytest.fixture(scope='module')
+def baselines():
+    with np.load(bench.BASELINE_FILE) as f:
+        return dict(f)
+
+
+@pytest.mark.parametrize('name, params, func',
+                         [pytest.param(name, params, func, id=bench._case_key(name, params))
+                          for name, params, func in bench.hot_path_cases()])
+def test_matches_baseline(baselines, name, params, func):
+    assert bench.matches_baseline(baselines, name, params, func()), \
+        f'{bench._case_key(name, params)} differs from the frozen baseline'